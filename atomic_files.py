@@ -0,0 +1,65 @@
+"""Create directories and files safely when several processes share them.
+
+The on-disk caches, e.g. ShapeCache in extract_fit_shapes.py and
+ColumnCache in column_cache.py, are used by concurrent worker processes.
+These helpers let them create their directories, rewrite their files, and
+serialize their updates without racing each other or exposing partially
+written files.
+"""
+import contextlib
+import fcntl
+import os
+import tempfile
+
+
+def makedirs(directory):
+    """Create a directory and its parents unless it already exists."""
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process may have created it in the meantime.
+            if not os.path.isdir(directory):
+                raise
+
+
+def write_atomically(path, write, mode='w'):
+    """Write a file through a temporary file renamed into place.
+
+    Concurrent readers see either the previous file or the complete new
+    one, but never a partially written file.
+
+    Parameters
+    ----------
+    path : path
+        The path to the file.
+    write : callable
+        A function called with the open temporary file to write its contents.
+    mode : string, optional
+        The mode the temporary file is opened with. The default is 'w'.
+    """
+    directory, name = os.path.split(path)
+    # The temporary file must be on the same file system for the rename to be atomic.
+    fd, tmp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory or '.')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def locked(path):
+    """Hold an exclusive lock on a lock file for the duration of a with block.
+
+    The lock is an advisory flock, so it only excludes other processes
+    taking the same lock, and the lock file is created if it doesn't exist.
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,256 @@
+"""A local cache of the columns of remote ntuples.
+
+One-off event queries tend to read the same few branches, e.g. run,
+luminosityBlock, event, the DNN scores, and the selection inputs, from
+the same XRootD files over and over again. A ColumnCache stores every
+branch read from a tree as a memory-mappable .npy file alongside a JSON
+manifest, so later queries needing only cached branches never open the
+source file. The total size of the cache is bounded, and the least
+recently used trees are evicted first.
+
+Both the cache and the source tree are read through the same interface,
+
+    reader = cache.open(path, 'Events', branches)
+    for start, stop in numpy_formula.chunk_ranges(reader.n_entries, chunk_size):
+        columns = reader.read(branches, start, stop)
+    reader.close()
+
+where a numpy_formula.TreeReader would read the tree directly instead.
+Several processes may share a cache. Each fills the missing branches
+into its own temporary files, and the manifest of a tree is merged and
+saved under a lock file.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+
+import atomic_files
+import numpy_formula
+from npy_appender import NpyAppender
+
+
+class CachedReader(object):
+    """Read ranges of entries of cached branches, as memory-mapped arrays.
+
+    Instances are returned by ColumnCache.open() and have the same
+    interface as a numpy_formula.TreeReader.
+    """
+    def __init__(self, n_entries, columns, sizes):
+        self.n_entries = n_entries
+        self._columns = columns
+        self._sizes = sizes
+
+    def size_branches(self, branches):
+        """Return the name of the size branch of each variable size branch."""
+        return dict((name, self._sizes[name]) for name in branches if name in self._sizes)
+
+    def read(self, branches, start, stop):
+        """Return the branches of the entries from start to stop."""
+        return numpy_formula.slice_columns(dict((name, self._columns[name]) for name in branches), start, stop)
+
+    def close(self):
+        pass
+
+
+class ColumnCache(object):
+    """An on-disk cache of the branches of ROOT trees.
+
+    Each tree gets a directory named by the hash of its source and tree
+    name. Scalar branches are stored as a single .npy file and variable
+    size branches as a pair of .npy files holding their content and
+    offsets. The manifest.json of the directory records the files of each
+    branch, its size branch, and when the tree was last used.
+
+    Local source files are validated against their size and modification
+    time whenever they are opened. Remote sources are never contacted once
+    their branches are cached, so a cached tree must be removed with
+    remove() if the remote file is rewritten.
+
+    Parameters
+    ----------
+    directory : path, optional
+        The directory holding the cache. It is created if it doesn't
+        exist. The default is ".column_cache" in the working directory.
+    max_bytes : int, optional
+        The maximum total size of the cached arrays. The least recently
+        used trees are evicted when it is exceeded. The default is 10 GiB.
+    chunk_size : int, optional
+        The number of entries read from a source tree at a time when
+        filling the cache. The default is 100000.
+    """
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, directory='.column_cache', max_bytes=10 * 2 ** 30, chunk_size=100000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        atomic_files.makedirs(self.directory)
+
+    def _entry_directory(self, path, tree):
+        """Return the directory of the cached branches of a tree."""
+        if os.path.exists(path):
+            path = os.path.abspath(path)
+        return os.path.join(self.directory, hashlib.sha1('\0'.join([path, tree])).hexdigest())
+
+    @staticmethod
+    def _identity(path):
+        """Return the size and modification time of a local source file,
+        or None for a remote one, which is not validated.
+        """
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def _load_manifest(self, entry):
+        try:
+            with open(os.path.join(entry, self.MANIFEST)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _save_manifest(self, entry, manifest):
+        atomic_files.write_atomically(
+            os.path.join(entry, self.MANIFEST),
+            lambda f: json.dump(manifest, f, indent=2, sort_keys=True),
+        )
+
+    def open(self, path, tree, branches):
+        """Return a CachedReader for the given branches of a tree.
+
+        Any branch which isn't cached yet is first read from the source
+        tree in a single pass and added to the cache.
+        """
+        branches = sorted(set(branches))
+        entry = self._entry_directory(path, tree)
+        identity = self._identity(path)
+        with atomic_files.locked(entry + '.lock'):
+            manifest = self._load_manifest(entry)
+            if manifest is not None and manifest['identity'] != identity:
+                # The local source file changed since it was cached.
+                shutil.rmtree(entry, ignore_errors=True)
+                manifest = None
+            atomic_files.makedirs(entry)
+        if manifest is None:
+            manifest = {'source': path, 'tree': tree, 'identity': identity, 'n_entries': None, 'columns': {}}
+        missing = [name for name in branches if name not in manifest['columns']]
+        if missing:
+            self._fill(path, tree, entry, manifest, missing)
+        manifest = self._merge_manifest(entry, manifest)
+        self.evict(keep=entry)
+        columns = {}
+        sizes = {}
+        for name in branches:
+            column = manifest['columns'][name]
+            arrays = [numpy.load(os.path.join(entry, x), mmap_mode='r') for x in column['files']]
+            columns[name] = numpy_formula.JaggedColumn(*arrays) if len(arrays) == 2 else arrays[0]
+            if column['size_branch']:
+                sizes[name] = column['size_branch']
+        return CachedReader(manifest['n_entries'], columns, sizes)
+
+    def _merge_manifest(self, entry, manifest):
+        """Add the columns of a manifest to the saved manifest of the entry,
+        which other processes may have extended in the meantime, and save it.
+        """
+        with atomic_files.locked(entry + '.lock'):
+            saved = self._load_manifest(entry)
+            if saved is not None and saved['identity'] == manifest['identity']:
+                for name, column in manifest['columns'].iteritems():
+                    saved['columns'].setdefault(name, column)
+                manifest = saved
+            manifest['last_used'] = time.time()
+            self._save_manifest(entry, manifest)
+        return manifest
+
+    def _fill(self, path, tree, entry, manifest, branches):
+        """Read branches from the source tree into the cache entry.
+
+        The arrays are written to temporary files unique to this process
+        and renamed into place once complete.
+        """
+        reader = numpy_formula.TreeReader(path, tree)
+        sizes = reader.size_branches(branches)
+        appenders = {}
+        files = {}
+        offsets = {}
+        try:
+            # An empty tree is read as a single empty chunk, which
+            # gives the branches the same layout as a non-empty tree.
+            for start, stop in numpy_formula.chunk_ranges(reader.n_entries, self.chunk_size) or [(0, 0)]:
+                chunk = reader.read(branches, start, stop)
+                for name in branches:
+                    column = chunk[name]
+                    jagged = isinstance(column, numpy_formula.JaggedColumn)
+                    if name not in appenders:
+                        files[name] = ['{0}.npy'.format(hashlib.sha1(name).hexdigest())]
+                        if jagged:
+                            files[name].append(files[name][0].replace('.npy', '.offsets.npy'))
+                        appenders[name] = [
+                            NpyAppender(self._temporary_file(entry, x), dtype)
+                            for x, dtype in zip(files[name], [column.content.dtype if jagged else column.dtype, numpy.int64])
+                        ]
+                        if jagged:
+                            appenders[name][1].write([0])
+                            offsets[name] = 0
+                    if jagged:
+                        appenders[name][0].write(column.content)
+                        appenders[name][1].write(column.offsets[1:] + offsets[name])
+                        offsets[name] += column.offsets[-1]
+                    else:
+                        appenders[name][0].write(column)
+        except Exception:
+            for name in appenders:
+                for appender in appenders[name]:
+                    appender.close()
+                    os.remove(appender.path)
+            raise
+        finally:
+            reader.close()
+        for name in branches:
+            nbytes = 0
+            for x, appender in zip(files[name], appenders[name]):
+                appender.close()
+                os.rename(appender.path, os.path.join(entry, x))
+                nbytes += os.path.getsize(os.path.join(entry, x))
+            manifest['columns'][name] = {'files': files[name], 'size_branch': sizes.get(name), 'nbytes': nbytes}
+        manifest['n_entries'] = reader.n_entries
+
+    @staticmethod
+    def _temporary_file(entry, name):
+        """Create a temporary file unique to this process for a cached array."""
+        fd, tmp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=entry)
+        os.close(fd)
+        return tmp_path
+
+    def remove(self, path, tree):
+        """Remove the cached branches of a tree."""
+        entry = self._entry_directory(path, tree)
+        with atomic_files.locked(entry + '.lock'):
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def evict(self, keep=None):
+        """Remove the least recently used trees until the cache fits
+        within max_bytes. The tree cached in the keep directory is never
+        removed, even if it alone exceeds the limit.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            manifest = self._load_manifest(entry)
+            if manifest is not None:
+                nbytes = sum(column['nbytes'] for column in manifest['columns'].itervalues())
+                entries.append((manifest.get('last_used', 0), entry, nbytes))
+        total = sum(nbytes for _, _, nbytes in entries)
+        for _, entry, nbytes in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if keep is not None and os.path.abspath(entry) == os.path.abspath(keep):
+                continue
+            with atomic_files.locked(entry + '.lock'):
+                shutil.rmtree(entry, ignore_errors=True)
+            total -= nbytes
@@ -6,12 +6,84 @@ import sys
 import numpy as np
 import ROOT
 
+import numpy_formula
+from numpy_formula import TreeReader
+from kinematics import FourVectors, gather, to_polar
+
 
 ROOT.gROOT.SetBatch(True)
 
 logging.basicConfig(format='[%(name)s] %(levelname)s - %(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# The jet categories, which accept arrays of jet pt and eta.
+CATEGORY_DEFINITIONS = {
+    'HighCentral': lambda pt, eta: (pt > 100) & (np.abs(eta) < 1.4),
+    'LowCentral': lambda pt, eta: (pt < 100) & (np.abs(eta) < 1.4),
+    'HighForward': lambda pt, eta: (pt > 100) & (np.abs(eta) > 1.4),
+    'LowForward': lambda pt, eta: (pt < 100) & (np.abs(eta) > 1.4),
+}
+
+MODIFIERS = list(itertools.product(['JEC', 'JER'], ['Up', 'Down'], ['HighCentral', 'LowCentral', 'HighForward', 'LowForward']))
+
+# The branches read to compute the new systematic branches.
+INPUT_BRANCHES = [
+    'hJCidx', 'Jet_pt_reg', 'Jet_eta', 'Jet_phi', 'Jet_mass',
+    'HCSV_reg_mass', 'HCSV_reg_pt', 'HCSV_reg_eta', 'HCSV_reg_phi',
+] + ['Jet_pt_reg_corr{0}{1}'.format(systematic, variation) for systematic in ('JEC', 'JER') for variation in ('Up', 'Down')]
+
+
+def compute_systematics(columns):
+    """Compute the decorrelated systematic branches for a chunk of entries.
+
+    The Higgs candidate is rebuilt from its jets with the regressed pt, and
+    again with the systematically varied pt of the jets in each category.
+    The HCSV_reg variables are scaled by the ratio of the varied and nominal
+    candidates. The jet pt takes the varied value only for jets in the category.
+
+    Parameters
+    ----------
+    columns : dict
+        The INPUT_BRANCHES of the chunk, as read by numpy_formula.
+
+    Returns
+    -------
+    values : dict
+        The new branches by name, as arrays for the HCSV_reg variables
+        and as the flat content of all jets for the jet pt.
+    """
+    n_entries = len(columns['HCSV_reg_pt'])
+    jet_indices = [gather(columns['hJCidx'], np.full(n_entries, i, dtype=np.int64))[0] for i in (0, 1)]
+    jets = []
+    for index in jet_indices:
+        jets.append(dict((name, gather(columns[name], index)[0]) for name in ('Jet_pt_reg', 'Jet_eta', 'Jet_phi', 'Jet_mass')))
+    higgs = None
+    for jet in jets:
+        jet_vector = FourVectors.from_pt_eta_phi_m(jet['Jet_pt_reg'], jet['Jet_eta'], jet['Jet_phi'], jet['Jet_mass'])
+        higgs = jet_vector if higgs is None else higgs + jet_vector
+    higgs_pt, higgs_eta, higgs_phi, higgs_mass = to_polar(*higgs.components)
+    jet_pt = columns['Jet_pt_reg'].content
+    jet_eta = columns['Jet_eta'].content
+    values = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for systematic, variation, category in MODIFIERS:
+            in_category = CATEGORY_DEFINITIONS[category]
+            corrected = columns['Jet_pt_reg_corr{systematic}{variation}'.format(**locals())]
+            # Only the jets in the category take the systematically varied pt.
+            higgs_syst = None
+            for jet, index in zip(jets, jet_indices):
+                pt = np.where(in_category(jet['Jet_pt_reg'], jet['Jet_eta']), gather(corrected, index)[0], jet['Jet_pt_reg'])
+                jet_syst = FourVectors.from_pt_eta_phi_m(pt, jet['Jet_eta'], jet['Jet_phi'], jet['Jet_mass'])
+                higgs_syst = jet_syst if higgs_syst is None else higgs_syst + jet_syst
+            pt, eta, phi, mass = to_polar(*higgs_syst.components)
+            values['HCSV_reg_corr{systematic}{variation}_mass_{category}'.format(**locals())] = columns['HCSV_reg_mass'] * (mass / higgs_mass)
+            values['HCSV_reg_corr{systematic}{variation}_pt_{category}'.format(**locals())] = columns['HCSV_reg_pt'] * (pt / higgs_pt)
+            values['HCSV_reg_corr{systematic}{variation}_eta_{category}'.format(**locals())] = columns['HCSV_reg_eta'] * (eta / higgs_eta)
+            values['HCSV_reg_corr{systematic}{variation}_phi_{category}'.format(**locals())] = columns['HCSV_reg_phi'] * (phi / higgs_phi)
+            values['Jet_pt_reg_corr{systematic}{variation}_{category}'.format(**locals())] = np.where(
+                in_category(jet_pt, jet_eta), corrected.content, jet_pt)
+    return values
+
 
 def main():
 
@@ -43,19 +115,10 @@ def main():
         'Jet_pt_reg_corr{systematic}{variation}_{category}',
     ]
 
-    category_definitions = {
-        'HighCentral': lambda pt, eta: pt > 100 and abs(eta) < 1.4,
-        'LowCentral': lambda pt, eta: pt < 100 and abs(eta) < 1.4,
-        'HighForward': lambda pt, eta: pt > 100 and abs(eta) > 1.4,
-        'LowForward': lambda pt, eta: pt < 100 and abs(eta) > 1.4,
-    }
-
-    modifiers = list(itertools.product(['JEC', 'JER'], ['Up', 'Down'], ['HighCentral', 'LowCentral', 'HighForward', 'LowForward']))
-
     # Create the new branches, setting their branch addresses to numpy arrays
     branch_addresses = {}
     for template in systematic_name_templates:
-        for systematic, variation, category in iter(modifiers):
+        for systematic, variation, category in iter(MODIFIERS):
             name = template.format(**locals())
             if 'Jet' in template:
                 branch_addresses[name] = np.zeros(50, dtype=np.float32)
@@ -68,72 +131,24 @@ def main():
     nentries = tree.GetEntriesFast()
     logger.info('Number of entries: %s', nentries)
 
-    for i, event in enumerate(tree):
-        if i % 10000 == 0:
-            logger.info('Processing event %s', i)
-        
-        # Set up four vectors for the nominal Higgs and its jets
-        higgs_jet_1 = ROOT.TLorentzVector()
-        higgs_jet_1.SetPtEtaPhiM(
-            event.Jet_pt_reg[event.hJCidx[0]],
-            event.Jet_eta[event.hJCidx[0]],
-            event.Jet_phi[event.hJCidx[0]],
-            event.Jet_mass[event.hJCidx[0]]
-        )
-
-        higgs_jet_2 = ROOT.TLorentzVector()
-        higgs_jet_2.SetPtEtaPhiM(
-            event.Jet_pt_reg[event.hJCidx[1]],
-            event.Jet_eta[event.hJCidx[1]],
-            event.Jet_phi[event.hJCidx[1]],
-            event.Jet_mass[event.hJCidx[1]]
-        )
-
-        higgs = higgs_jet_1 + higgs_jet_2
-
-        for systematic, variation, category in iter(modifiers):
-
-            # Set up the four vectors for the systematically varied Higgs and its jets
-            higgs_jet_syst_1 = ROOT.TLorentzVector()
-            higgs_jet_syst_2 = ROOT.TLorentzVector()
-
-            if category_definitions[category](event.Jet_pt_reg[event.hJCidx[0]], event.Jet_eta[event.hJCidx[0]]):
-                higgs_jet_syst_1.SetPtEtaPhiM(
-                    getattr(event, 'Jet_pt_reg_corr{systematic}{variation}'.format(**locals()))[event.hJCidx[0]],
-                    event.Jet_eta[event.hJCidx[0]],
-                    event.Jet_phi[event.hJCidx[0]],
-                    event.Jet_mass[event.hJCidx[0]]
-                )
-            else:
-                higgs_jet_syst_1 = higgs_jet_1
-        
-            if category_definitions[category](event.Jet_pt_reg[event.hJCidx[1]], event.Jet_eta[event.hJCidx[1]]):
-                higgs_jet_syst_2.SetPtEtaPhiM(
-                    getattr(event, 'Jet_pt_reg_corr{systematic}{variation}'.format(**locals()))[event.hJCidx[1]],
-                    event.Jet_eta[event.hJCidx[1]],
-                    event.Jet_phi[event.hJCidx[1]],
-                    event.Jet_mass[event.hJCidx[1]]
-                )
-            else:
-                higgs_jet_syst_2 = higgs_jet_2
-
-            higgs_syst = higgs_jet_syst_1 + higgs_jet_syst_2
-
-            # Assign newly calculated values to branch addresses
-            branch_addresses['HCSV_reg_corr{systematic}{variation}_mass_{category}'.format(**locals())][0] = event.HCSV_reg_mass * (higgs_syst.M()/higgs.M())
-            branch_addresses['HCSV_reg_corr{systematic}{variation}_pt_{category}'.format(**locals())][0] = event.HCSV_reg_pt * (higgs_syst.Pt()/higgs.Pt())
-            branch_addresses['HCSV_reg_corr{systematic}{variation}_eta_{category}'.format(**locals())][0] = event.HCSV_reg_eta * (higgs_syst.Eta()/higgs.Eta())
-            branch_addresses['HCSV_reg_corr{systematic}{variation}_phi_{category}'.format(**locals())][0] = event.HCSV_reg_phi * (higgs_syst.Phi()/higgs.Phi())
-
-            jet_branch_new = 'Jet_pt_reg_corr{systematic}{variation}_{category}'.format(**locals())
-            jet_branch_old = 'Jet_pt_reg_corr{systematic}{variation}'.format(**locals())
-            for j in xrange(event.nJet):
-                if category_definitions[category](event.Jet_pt_reg[j], event.Jet_eta[j]):
-                    branch_addresses[jet_branch_new][j] = getattr(tree, jet_branch_old)[j]
+    # Compute the new branches a chunk of entries at a time, then fill them event by event.
+    reader = TreeReader(inpath, 'tree')
+    for start, stop in numpy_formula.chunk_ranges(nentries, 10000):
+        columns = reader.read(INPUT_BRANCHES, start, stop)
+        values = compute_systematics(columns)
+        offsets = columns['Jet_pt_reg'].offsets
+        for i in xrange(start, stop):
+            if i % 10000 == 0:
+                logger.info('Processing event %s', i)
+            tree.GetEntry(i)
+            j = i - start
+            for name, value in values.iteritems():
+                if name.startswith('Jet'):
+                    branch_addresses[name][:offsets[j + 1] - offsets[j]] = value[offsets[j]:offsets[j + 1]]
                 else:
-                    branch_addresses[jet_branch_new][j] = event.Jet_pt_reg[j]
-          
-        tree_clone.Fill()
+                    branch_addresses[name][0] = value[j]
+            tree_clone.Fill()
+    reader.close()
 
     # Save the new tree and close the files
     tree_clone.Write()
@@ -1,6 +1,18 @@
+import collections
+import hashlib
+import multiprocessing
+import os
+
 import ROOT
 import numpy
 
+import atomic_files
+
+
+# A picklable snapshot of a one-dimensional histogram which is passed
+# between the extraction workers and the process writing the output file.
+SerializedShape = collections.namedtuple('SerializedShape', ['name', 'class_name', 'title', 'edges', 'contents', 'errors'])
+
 
 class PrefitFile(object):
     def __init__(self, path):
@@ -18,6 +30,17 @@ class PrefitFile(object):
         f.Close()
         return shapes
 
+    def get_serialized_shapes(self, cache=None):
+        """Get the prefit shapes as a list of SerializedShape,
+        serving them from a ShapeCache if the file is unchanged.
+        """
+        shapes = cache.get(self.path) if cache else None
+        if shapes is None:
+            shapes = [serialize_shape(shape) for shape in self.get_shapes()]
+            if cache:
+                cache.put(self.path, '', shapes)
+        return shapes
+
 
 class MlfitFile(object):
     def __init__(self, path):
@@ -45,6 +68,195 @@ class MlfitFile(object):
             hrebin.SetBinError(i, shape.GetBinError(i))
         return hrebin
 
+    def get_serialized_shapes(self, folder, x_bins, cache=None):
+        """Get the postfit shapes inside a given folder as a list of
+        SerializedShape, rebinning them according to x_bins. The shapes
+        are served from a ShapeCache if the file is unchanged.
+        """
+        shapes = cache.get(self.path, folder) if cache else None
+        if shapes is None:
+            f = ROOT.TFile.Open(self.path)
+            f.cd(folder)
+            shapes = [
+                serialize_shape(key.ReadObj()) for key in ROOT.gDirectory.GetListOfKeys()
+                if key.GetName() not in {'data', 'total_covar'}
+            ]
+            f.Close()
+            if cache:
+                cache.put(self.path, folder, shapes)
+        return [self._rebin_serialized_shape(shape, x_bins) for shape in shapes]
+
+    def get_covariance(self, folder=None, fit='shapes_fit_s'):
+        """Get a postfit covariance matrix as a numpy array.
+
+        Parameters
+        ----------
+        folder : string, optional
+            The folder containing the "total_covar" histogram of a channel,
+            e.g. 'shapes_fit_s/WlnHbb_Wen_SR'. The default is None, in which
+            case the "overall_total_covar" histogram of the fit is used,
+            which also includes the correlations between channels.
+        fit : string, optional
+            The fit folder holding "overall_total_covar". The default is
+            "shapes_fit_s". This is ignored if folder is given.
+
+        Returns
+        -------
+        labels : list of strings
+            The bin labels of the covariance matrix. These are only filled
+            for "overall_total_covar", which labels bins by channel.
+        covariance : numpy.array of floats
+            The covariance matrix of shape (n_bins, n_bins).
+        """
+        f = ROOT.TFile.Open(self.path)
+        if folder is None:
+            h = f.Get('{0}/overall_total_covar'.format(fit))
+        else:
+            h = f.Get('{0}/total_covar'.format(folder))
+        n_bins = h.GetNbinsX()
+        x_axis = h.GetXaxis()
+        labels = [x_axis.GetBinLabel(i) for i in xrange(1, n_bins + 1)]
+        covariance = numpy.array(
+            [[h.GetBinContent(i, j) for j in xrange(1, n_bins + 1)] for i in xrange(1, n_bins + 1)],
+            dtype=numpy.float64,
+        )
+        f.Close()
+        return labels, covariance
+
+    def get_uncertainties(self, folder=None, merged_bins=None, combinations=None, fit='shapes_fit_s'):
+        """Compute postfit uncertainties from a covariance matrix in one call.
+
+        Every requested uncertainty is a linear combination of bins, so the
+        per-bin bands, merged bins, and arbitrary combinations are stacked
+        into a single weight matrix W and propagated together as the square
+        root of the diagonal of W C W^T.
+
+        Parameters
+        ----------
+        folder : string, optional
+            The folder containing the "total_covar" histogram of a channel.
+            The default is None for the "overall_total_covar" histogram.
+            See get_covariance for details.
+        merged_bins : list of lists of ints, optional
+            Groups of zero-based bin indices. The uncertainty on the summed
+            content of each group is computed, accounting for correlations.
+        combinations : numpy array-like, optional
+            An array of shape (n_combinations, n_bins) holding the coefficients
+            of arbitrary linear combinations of bins, e.g. rows selecting the
+            bins of several channels from the overall covariance to sum them.
+        fit : string, optional
+            The fit folder holding "overall_total_covar". The default is
+            "shapes_fit_s".
+
+        Returns
+        -------
+        uncertainties : dict
+            A dictionary with the keys
+              * labels, the bin labels of the covariance matrix
+              * bins, the per-bin uncertainty band
+              * merged_bins, the uncertainty of each group of merged bins
+              * combinations, the uncertainty of each linear combination
+        """
+        labels, covariance = self.get_covariance(folder, fit)
+        n_bins = len(covariance)
+        merged_bins = merged_bins or []
+        merged_weights = numpy.zeros((len(merged_bins), n_bins), dtype=numpy.float64)
+        for i, group in enumerate(merged_bins):
+            merged_weights[i, group] = 1
+        if combinations is None:
+            combinations = numpy.zeros((0, n_bins), dtype=numpy.float64)
+        combinations = numpy.atleast_2d(numpy.asarray(combinations, dtype=numpy.float64))
+        weights = numpy.vstack([numpy.identity(n_bins), merged_weights, combinations])
+        sigma = propagate_uncertainty(covariance, weights)
+        return {
+            'labels': labels,
+            'bins': sigma[:n_bins],
+            'merged_bins': sigma[n_bins:n_bins + len(merged_bins)],
+            'combinations': sigma[n_bins + len(merged_bins):],
+        }
+
+    def _rebin_serialized_shape(self, shape, x_bins):
+        """Rebin a serialized postfit shape to match its prefit binning.
+        As for _rebin_shape, the underflow and overflow bins are dropped.
+        """
+        n_bins = min(len(x_bins), len(shape.edges)) - 1
+        contents = numpy.zeros(len(x_bins) + 1, dtype=numpy.float64)
+        errors = numpy.zeros(len(x_bins) + 1, dtype=numpy.float64)
+        contents[1:n_bins + 1] = shape.contents[1:n_bins + 1]
+        errors[1:n_bins + 1] = shape.errors[1:n_bins + 1]
+        return SerializedShape(shape.name, 'TH1F', '', numpy.asarray(x_bins, dtype=numpy.float64), contents, errors)
+
+
+class ShapeCache(object):
+    """An on-disk cache of serialized shapes.
+
+    The shapes read from a folder of a ROOT file are stored as a compact
+    .npz file keyed by the path, size, and modification time of the file
+    as well as the folder name. Unchanged inputs are then served without
+    opening the ROOT file at all.
+
+    Parameters
+    ----------
+    directory : path, optional
+        The directory holding the cache files. It is created if it doesn't
+        exist. The default is ".shape_cache" in the working directory.
+    """
+    def __init__(self, directory='.shape_cache'):
+        self.directory = directory
+        atomic_files.makedirs(self.directory)
+
+    def _cache_path(self, path, folder):
+        """Return the path of the cache file for a folder of a source file."""
+        stat = os.stat(path)
+        identity = '\0'.join([os.path.abspath(path), str(stat.st_size), repr(stat.st_mtime), folder])
+        return os.path.join(self.directory, hashlib.sha1(identity).hexdigest() + '.npz')
+
+    def get(self, path, folder=''):
+        """Return the cached shapes as a list of SerializedShape,
+        or None if the source file or folder is not cached.
+        """
+        cache_path = self._cache_path(path, folder)
+        if not os.path.isfile(cache_path):
+            return None
+        with numpy.load(cache_path) as cached:
+            # Each member of an NpzFile is read from disk whenever it is
+            # accessed, so read every array once up front.
+            names, class_names, titles, n_edges, edges, contents, errors = [
+                cached[key] for key in ('names', 'class_names', 'titles', 'n_edges', 'edges', 'contents', 'errors')
+            ]
+        # Every histogram has one more bin edge than bins,
+        # but also carries the underflow and overflow bins.
+        edge_offsets = numpy.concatenate([[0], numpy.cumsum(n_edges)])
+        bin_offsets = numpy.concatenate([[0], numpy.cumsum(n_edges + 1)])
+        return [
+            SerializedShape(
+                name=str(names[i]),
+                class_name=str(class_names[i]),
+                title=str(titles[i]),
+                edges=edges[edge_offsets[i]:edge_offsets[i + 1]],
+                contents=contents[bin_offsets[i]:bin_offsets[i + 1]],
+                errors=errors[bin_offsets[i]:bin_offsets[i + 1]],
+            )
+            for i in xrange(len(names))
+        ]
+
+    def put(self, path, folder, shapes):
+        """Store the shapes read from a folder of a source file."""
+        cache_path = self._cache_path(path, folder)
+        # Start each concatenation with an empty array so that a folder
+        # without shapes is cached as empty arrays.
+        empty = numpy.empty(0, dtype=numpy.float64)
+        arrays = {
+            'names': numpy.array([shape.name for shape in shapes], dtype=str),
+            'class_names': numpy.array([shape.class_name for shape in shapes], dtype=str),
+            'titles': numpy.array([shape.title for shape in shapes], dtype=str),
+            'n_edges': numpy.array([len(shape.edges) for shape in shapes], dtype=numpy.int64),
+            'edges': numpy.concatenate([empty] + [shape.edges for shape in shapes]),
+            'contents': numpy.concatenate([empty] + [shape.contents for shape in shapes]),
+            'errors': numpy.concatenate([empty] + [shape.errors for shape in shapes]),
+        }
+        atomic_files.write_atomically(cache_path, lambda f: numpy.savez(f, **arrays), mode='wb')
+
 
 def get_x_bins(histogram):
     """Return an array of bin low edges and the upper edge of the last bin for a histogram.
@@ -54,6 +266,27 @@ def get_x_bins(histogram):
     return numpy.array(x_bins, dtype=numpy.float64)
 
 
+def propagate_uncertainty(covariance, weights):
+    """Return the uncertainties of linear combinations of correlated bins.
+
+    Parameters
+    ----------
+    covariance : numpy.array of floats
+        The covariance matrix of shape (n_bins, n_bins).
+    weights : numpy.array of floats
+        The coefficients of the linear combinations as an
+        array of shape (n_combinations, n_bins).
+
+    Returns
+    -------
+    numpy.array of floats
+        The square root of the diagonal of W C W^T, of shape (n_combinations,).
+        Negative variances from numerical noise are clipped to zero.
+    """
+    variances = numpy.einsum('ij,jk,ik->i', weights, covariance, weights)
+    return numpy.sqrt(numpy.clip(variances, 0, None))
+
+
 def write_objects(objects, dst, directory):
     """Write an iterable collection of objects to a directory in a ROOT file.
     """
@@ -63,6 +296,123 @@ def write_objects(objects, dst, directory):
         obj.Write()
 
 
+def serialize_shape(shape):
+    """Convert a histogram into a SerializedShape. The contents and errors
+    include the underflow and overflow bins.
+    """
+    n_bins = shape.GetNbinsX()
+    return SerializedShape(
+        name=shape.GetName(),
+        class_name=shape.ClassName(),
+        title=shape.GetTitle(),
+        edges=get_x_bins(shape),
+        contents=numpy.array([shape.GetBinContent(i) for i in xrange(n_bins + 2)], dtype=numpy.float64),
+        errors=numpy.array([shape.GetBinError(i) for i in xrange(n_bins + 2)], dtype=numpy.float64),
+    )
+
+
+def deserialize_shape(shape):
+    """Rebuild the histogram described by a SerializedShape.
+    """
+    h = getattr(ROOT, shape.class_name)(shape.name, shape.title, len(shape.edges) - 1, shape.edges)
+    for i, (content, error) in enumerate(zip(shape.contents, shape.errors)):
+        h.SetBinContent(i, content)
+        h.SetBinError(i, error)
+    h.SetDirectory(0)
+    return h
+
+
+def extract_channel(task):
+    """Read the prefit and postfit shapes of a single analysis channel.
+
+    This is the unit of work handed to the worker pool by extract_fit_shapes,
+    so the histograms are returned in serialized form.
+
+    Parameters
+    ----------
+    task : tuple
+        A tuple of the analysis name, channel bin name, PrefitFile,
+        MlfitFile, the channel's folder within the mlfit.root file,
+        and a ShapeCache or None.
+
+    Returns
+    -------
+    results : list of tuples
+        A list of (directory, shapes) pairs, where directory is the output
+        directory and shapes is a list of SerializedShape.
+    """
+    name, channel_bin, prefit_file, mlfit_file, folder, cache = task
+    prefit_shapes = prefit_file.get_serialized_shapes(cache)
+    x_bins = prefit_shapes[0].edges
+    data_copy = [shape for shape in prefit_shapes if shape.name == 'data_obs'][0]
+    postfit_shapes = mlfit_file.get_serialized_shapes(folder, x_bins, cache)
+    postfit_shapes.append(data_copy)
+    return [
+        ('{0}/prefit/{1}'.format(name, channel_bin), prefit_shapes),
+        ('{0}/postfit/{1}'.format(name, channel_bin), postfit_shapes),
+    ]
+
+
+def _write_serialized_shapes(queue, path):
+    """Write the serialized shapes arriving on a queue to a ROOT file
+    until the sentinel value None is received.
+    """
+    outfile = ROOT.TFile.Open(path, 'recreate')
+    for directory, shapes in iter(queue.get, None):
+        write_objects([deserialize_shape(shape) for shape in shapes], outfile, directory)
+    outfile.Close()
+
+
+def extract_fit_shapes(analyses, mlfit_directories, dst, processes=None, cache=None):
+    """Extract the prefit and postfit shapes of every analysis channel into a ROOT file.
+
+    The channels are read concurrently by a pool of worker processes, while
+    a single writer process owns the output file. The wall time is therefore
+    driven by the slowest channel rather than the sum over all channels.
+
+    Parameters
+    ----------
+    analyses : list of dicts
+        The analyses, each a dictionary with the keys "name", "prefit", and
+        "mlfit" mapping to its name, a dictionary of channel bin names to
+        PrefitFile, and its MlfitFile, respectively.
+    mlfit_directories : dict
+        The folder within the mlfit.root file for each channel bin.
+    dst : path
+        The path to the output ROOT file.
+    processes : int, optional
+        The number of worker processes. The default is the number
+        of CPUs, up to the number of channels.
+    cache : ShapeCache, optional
+        The cache used to skip reading unchanged input files.
+        The default is None for no caching.
+    """
+    tasks = [
+        (analysis['name'], channel_bin, prefit_file, analysis['mlfit'], mlfit_directories[channel_bin], cache)
+        for analysis in analyses
+        for channel_bin, prefit_file in analysis['prefit'].iteritems()
+    ]
+    queue = multiprocessing.Queue()
+    writer = multiprocessing.Process(target=_write_serialized_shapes, args=(queue, dst))
+    writer.start()
+    try:
+        # Without any channels, the writer only creates an empty output file.
+        if tasks:
+            pool = multiprocessing.Pool(processes or min(len(tasks), multiprocessing.cpu_count()))
+            try:
+                for results in pool.imap_unordered(extract_channel, tasks):
+                    for result in results:
+                        queue.put(result)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        queue.put(None)
+        writer.join()
+    if writer.exitcode:
+        raise RuntimeError('The writer process for {0} exited with code {1}'.format(dst, writer.exitcode))
+
+
 if __name__ == '__main__':
 
     VH = {
@@ -104,19 +454,4 @@ if __name__ == '__main__':
     }
 
 
-    outfile = ROOT.TFile.Open('fit_shapes.root', 'recreate')
-    for analysis in [VH, VZ]:
-        data_copy, x_bins = {}, {}
-        for channel_bin, prefit_file in analysis['prefit'].iteritems():
-            shapes = prefit_file.get_shapes()
-            x_bins[channel_bin] = get_x_bins(shapes[0])
-            data_copy[channel_bin] = [shape for shape in shapes if shape.GetName() == 'data_obs'][0]
-            outdir = '{0}/prefit/{1}'.format(analysis['name'], channel_bin)
-            write_objects(shapes, outfile, outdir)
-        for channel_bin, indir in MLFIT_DIRECTORIES.iteritems():
-            shapes = analysis['mlfit'].get_shapes(indir, x_bins[channel_bin])
-            shapes.append(data_copy[channel_bin])
-            outdir = '{0}/postfit/{1}'.format(analysis['name'], channel_bin)
-            write_objects(shapes, outfile, outdir)
-    outfile.Close()
-
+    extract_fit_shapes([VH, VZ], MLFIT_DIRECTORIES, 'fit_shapes.root', cache=ShapeCache())
@@ -1,14 +1,24 @@
+import Queue
 import collections
 import csv
+import itertools
+import json
+import multiprocessing
 import os
 import sys
+import threading
 import warnings
 
 import ROOT
 import numpy
+import root_numpy
 
+import numpy_formula
+from npy_appender import NpyAppender
 
-def featurize_ntuple(ntuples=[], selection='', feature_dict={}, save_label='file', outfile=('Preprocessed.csv', True)):
+
+def featurize_ntuple(ntuples=[], selection='', feature_dict={}, save_label='file', outfile=('Preprocessed.csv', True), engine='formula', chunk_size=100000,
+                     processes=None, entries_per_task=None, incremental=False):
     """
     Parameters
     ---------- 
@@ -16,7 +26,8 @@ def featurize_ntuple(ntuples=[], selection='', feature_dict={}, save_label='file
         The absolute path to the ntuples' directory.
     ntuples : list of paths
         The paths of the ntuples to featurize. Automatically generated class
-        labels for each ntuple are based on their order in this list.           
+        labels for each ntuple are based on their order in this list.
+        Wildcards are expanded as by TChain.Add, see expand_ntuples.           
     selection : string
         A boolean TTreeFormula expression used to filter examples in 
         the ntuple. For example, for each training event we require
@@ -43,118 +54,766 @@ def featurize_ntuple(ntuples=[], selection='', feature_dict={}, save_label='file
     outfile : list of tuples of (string, bool)
         A list describing the output file storing the preprocessing results.
         - The first item is the name, with extension, of the output file.
-          Valid file extensions are .csv and .root. Passing an empty string
-          creates by default 'ProcessedNtuple.csv'.
+          Valid file extensions are .csv, .root, .npy, .npz, and .columns.
+          Passing an empty string creates by default 'ProcessedNtuple.csv'.
+          The binary formats name their fields like the .root branches:
+            * .npy, a structured array which can be memory-mapped,
+              with a sidecar manifest of the columns named after the
+              output with the suffix .json, e.g. out.npy.json
+            * .npz, an array per column, with a sidecar out.npz.json manifest
+            * .columns, a directory holding a memory-mappable .npy file
+              per column and a manifest.json. See load_columns.
         - The second item flags whether a header line, a row concatenating
           the feature names, is written first to the .csv file.
           The default is True.
+    engine : string
+        The engine evaluating the expressions. The default 'formula' loops
+        over the entries, evaluating a TTreeFormula for each expression.
+        The 'numpy' engine reads only the referenced branches in chunks and
+        evaluates the expressions as NumPy operations. Both produce the
+        same rows.
+    chunk_size : int
+        The number of entries read per chunk. The output is written
+        a chunk at a time. The default is 100000.
+    processes : int
+        The number of worker processes. If greater than one, each ntuple
+        or range of entries is featurized in parallel with its class label
+        fixed up front, and the results are merged in the original order.
+        The output is the same as for the serial run, byte for byte except
+        for the .root format. The default is None for a serial run.
+    entries_per_task : int
+        The number of entries per parallel task, allowing large ntuples to
+        be split across workers. The default is None for a task per ntuple.
+    incremental : bool
+        Whether to only featurize the ntuples which were added since the
+        last run, appending their rows to the existing output. The identity
+        (path, size, and modification time) of each ntuple and the selection,
+        feature, and label definitions are recorded in a manifest next to the
+        output, named after it with the suffix .sources.json. If the
+        definitions changed, or an ntuple was changed, removed, or reordered,
+        the output is rebuilt from scratch. The .npz format can't be
+        appended to, so it doesn't support incremental runs. The default
+        is False.
     """
-    # Create the chain of ntuples.
-    chain = ROOT.TChain('tree')
-    for ntuple in ntuples:
-        chain.Add(ntuple)
-    # Intialize the selection expression.
-    sel = ROOT.TTreeFormula('sel', selection, chain)
-    # Initialize the feature expressions.
-    exps = [ROOT.TTreeFormula(x, feature_dict[x], chain) for x in feature_dict]
-    # Initialize the class label expression, if provided.
-    has_label_exp = False
-    if save_label and (save_label != 'file'):
-        label = ROOT.TTreeFormula('label', save_label, chain)
-        has_label_exp = True
     # Parse the output file extension.
     if not outfile[0]:
-        outfile[0] = 'ProcessedNtuple.csv'
+        outfile = ('ProcessedNtuple.csv',) + tuple(outfile[1:])
+    writer_class = OUTPUT_WRITERS.get(_output_extension(outfile[0]))
+    if writer_class is None:
+        raise ValueError('Unsupported output file extension: {0}'.format(outfile[0]))
+    if incremental and writer_class is NpzWriter:
+        raise ValueError('Incremental runs cannot append to the .npz format, use the .npy or .columns format instead')
+    ntuples = expand_ntuples(ntuples)
+    # Find the ntuples which were already featurized by a previous run.
+    first_fnum = 0
+    if incremental:
+        manifest_path = outfile[0].rstrip('/') + '.sources.json'
+        definition = _featurization_definition(selection, feature_dict, save_label)
+        sources = [_source_identity(ntuple) for ntuple in ntuples]
+        first_fnum = _count_unchanged_sources(manifest_path, outfile[0], definition, sources)
+        # The manifest is only restored once the output is consistent with it again.
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+    chunks = _iter_chunks(ntuples[first_fnum:], selection, feature_dict, save_label, chunk_size,
+                          engine, processes, entries_per_task, first_fnum)
     print '--- Generating %s with...' % outfile[0]
     print '--- Selection'
     print '---    %s' % selection
     print '--- Features'
     if (save_label == 'file'):
         print '---    %s, %s' % ('Class/I', 'File Number')
-    elif has_label_exp:
+    elif save_label:
         print '---    %s, %s' % ('Class/I', save_label)
     for x in feature_dict:
         print '---    %s, %s' % (x, feature_dict[x])
-    # Process the chain, saving the output as a .csv file.
-    if (outfile[0].endswith('.csv')):
-        with open(outfile[0], 'w') as csv_file:
-            writer = csv.writer(csv_file)
-            # Header Row
-            if outfile[1]:
-                if save_label:
-                    writer.writerow(['Class/I'] + [x for x in feature_dict])
-                else:
-                    writer.writerow([x for x in feature_dict])
-            # Example Rows
-            print '--- Processing %s' % os.path.basename(chain.GetFile().GetName())
-            fnum = chain.GetTreeNumber()
-            for example in chain:
-                # Update the file number and TTreeFormulas when the TChain opens the next file.
-                if (chain.GetTreeNumber() != fnum):
-                    print '--- Processing %s' % os.path.basename(chain.GetFile().GetName())
-                    fnum = chain.GetTreeNumber()
-                    sel.UpdateFormulaLeaves()
-                    for exp in exps:
-                        exp.UpdateFormulaLeaves()
-                    if has_label_exp:
-                        label.UpdateFormulaLeaves()
-                # This call is ESSENTIAL for formulae whose leaves have variable size.
-                sel.GetNdata()
-                for exp in exps:
-                    exp.GetNdata()
-                if has_label_exp:
-                    label.GetNdata()
-                if sel.EvalInstance():
-                    if (save_label == 'file'):
-                        writer.writerow([fnum] + [exp.EvalInstance() for exp in exps])
-                    elif has_label_exp:
-                        writer.writerow([label.EvalInstance()] + [exp.EvalInstance() for exp in exps])
-                    else:
-                        writer.writerow([exp.EvalInstance() for exp in exps])
-    # Process the chain, saving the output as a .root file.
-    elif (outfile[0].endswith('.root')):
-        # Create the file and TTree. 
-        root_file = ROOT.TFile(outfile[0], 'RECREATE')
-        root_tree = ROOT.TTree('features', '')
-        # Create branch addresses and TBranches for each feature.
-        root_to_np_type = {'I': numpy.int32, 'F': numpy.float32, 'D': numpy.float64}
-        if save_label:
-            label_address = numpy.array([-999], numpy.int32)
-            root_tree.Branch('Class', label_address, 'Class/I')
-        branch_addresses = [numpy.array([-999], root_to_np_type[x[-1]]) for x in feature_dict]
-        for x, address in zip(feature_dict, branch_addresses):
-            root_tree.Branch(x[:-2], address, x)
-        # Loop over all entries.
-        print '--- Processing %s' % os.path.basename(chain.GetFile().GetName())
-        fnum = chain.GetTreeNumber()
-        for entry in chain:
-            # Update the class label and TTreeFormulas when the TChain opens the next file.
-            if (chain.GetTreeNumber() != fnum):
-                print '--- Processing %s' % os.path.basename(chain.GetFile().GetName())
-                fnum = chain.GetTreeNumber()
-                sel.UpdateFormulaLeaves()
-                for exp in exps:
-                    exp.UpdateFormulaLeaves()
-                if has_label_exp:
-                    label.UpdateFormulaLeaves()
+    if first_fnum:
+        print '--- Skipping %s unchanged ntuples' % first_fnum
+    # Process the ntuples, writing the output a chunk at a time.
+    writer = writer_class(outfile[0], feature_dict, save_label, header=outfile[1], append=first_fnum > 0)
+    for labels, features in chunks:
+        writer.write(labels, features)
+    writer.close()
+    if incremental:
+        with open(manifest_path, 'w') as f:
+            json.dump({'definition': definition, 'sources': sources}, f, indent=2, sort_keys=True)
+
+
+def expand_ntuples(ntuples):
+    """Expand the wildcards of ntuple paths or urls, e.g. 'root://.../*.root',
+    into the files they match, as TChain.Add does. Like the files added to a
+    TChain, every matched file is a separate ntuple with its own file number.
+    """
+    expanded = []
+    for ntuple in ntuples:
+        if '*' not in ntuple and '?' not in ntuple:
+            expanded.append(ntuple)
+            continue
+        chain = ROOT.TChain('tree')
+        chain.Add(ntuple)
+        files = [element.GetTitle() for element in chain.GetListOfFiles()]
+        if not files:
+            raise IOError('No ntuples match {0}'.format(ntuple))
+        expanded.extend(files)
+    return expanded
+
+
+def _featurization_definition(selection, feature_dict, save_label):
+    """Describe the expressions determining the output rows, for the incremental manifest."""
+    return {
+        'selection': selection,
+        'features': [[x, feature_dict[x]] for x in feature_dict],
+        'save_label': save_label,
+    }
+
+
+def _source_identity(ntuple):
+    """Return the path, size, and modification time of an ntuple. Remote
+    files, e.g. XRootD urls, are opened to query them from ROOT.
+    """
+    if os.path.exists(ntuple):
+        stat = os.stat(ntuple)
+        return {'path': os.path.abspath(ntuple), 'size': stat.st_size, 'mtime': stat.st_mtime}
+    f = ROOT.TFile.Open(ntuple)
+    identity = {'path': ntuple, 'size': f.GetSize(), 'mtime': f.GetModificationDate().Convert()}
+    f.Close()
+    return identity
+
+
+def _count_unchanged_sources(manifest_path, output_path, definition, sources):
+    """Return the number of leading ntuples already featurized into the
+    output with the same definitions, or zero if the output must be rebuilt.
+    """
+    if not (os.path.exists(manifest_path) and os.path.exists(output_path)):
+        return 0
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest['definition'] != json.loads(json.dumps(definition)):
+        return 0
+    recorded = manifest['sources']
+    # The class labels are file numbers, so previously featurized ntuples
+    # must be unchanged and in the same positions for the rows to be kept.
+    if recorded != json.loads(json.dumps(sources[:len(recorded)])) or len(recorded) > len(sources):
+        return 0
+    return len(recorded)
+
+
+def iter_formula_chunks(ntuples=[], selection='', feature_dict={}, save_label='file', chunk_size=100000, first_fnum=0):
+    """Evaluate the selection, features, and class labels of the ntuples
+    entry by entry using TTreeFormulas, collecting them into chunks.
+
+    The parameters and yielded values are those of iter_feature_chunks.
+    """
+    for fnum, ntuple in enumerate(expand_ntuples(ntuples), first_fnum):
+        for chunk in _iter_formula_file_chunks(ntuple, fnum, selection, feature_dict, save_label, chunk_size):
+            yield chunk
+
+
+def _referenced_branches(tree, formulas, expressions):
+    """Return the names of the branches read by a set of TTreeFormulas.
+
+    The leaves of each formula are combined with those found by parsing
+    its expression, which also covers the leaves of index subexpressions
+    such as hJCidx in 'Jet_pt[hJCidx[0]]'. The branches holding the sizes
+    of variable size leaves are included as well.
+    """
+    leaves = []
+    for formula in formulas:
+        leaves.extend(formula.GetLeaf(i) for i in xrange(formula.GetNcodes()))
+    for expression in expressions:
+        try:
+            names = numpy_formula.leaves(numpy_formula.parse(expression))
+        except numpy_formula.FormulaError:
+            continue
+        leaves.extend(tree.GetLeaf(name) for name in names)
+    branches = set()
+    for leaf in leaves:
+        if not leaf:
+            continue
+        branches.add(leaf.GetBranch().GetName())
+        if leaf.GetLeafCount():
+            branches.add(leaf.GetLeafCount().GetBranch().GetName())
+    return branches
+
+
+def _iter_formula_file_chunks(ntuple, fnum, selection, feature_dict, save_label, chunk_size, start=0, stop=None):
+    """Evaluate a range of entries of a single ntuple using TTreeFormulas.
+    The file number fnum is the class label when save_label is 'file'.
+
+    Only the branches referenced by the expressions are left active, and
+    the selection is evaluated first. As TTreeFormulas load the branches
+    they need for the current entry themselves, the feature and label
+    branches are only read for entries passing the selection.
+    """
+    f = ROOT.TFile.Open(ntuple)
+    tree = f.Get('tree')
+    # Intialize the selection expression.
+    sel = ROOT.TTreeFormula('sel', selection, tree)
+    # Initialize the feature expressions.
+    exps = [ROOT.TTreeFormula(x, feature_dict[x], tree) for x in feature_dict]
+    # Initialize the class label expression, if provided.
+    has_label_exp = False
+    if save_label and (save_label != 'file'):
+        label = ROOT.TTreeFormula('label', save_label, tree)
+        has_label_exp = True
+    label_type = numpy.int64 if (save_label == 'file') else numpy.float64
+    # Deactivate every branch which isn't referenced by an expression.
+    formulas = [sel] + exps + ([label] if has_label_exp else [])
+    expressions = [selection] + list(feature_dict.values()) + ([save_label] if has_label_exp else [])
+    tree.SetBranchStatus('*', 0)
+    for branch in _referenced_branches(tree, formulas, expressions):
+        tree.SetBranchStatus(branch, 1)
+    print '--- Processing %s' % os.path.basename(ntuple)
+    stop = tree.GetEntries() if stop is None else min(stop, tree.GetEntries())
+    for chunk_start in xrange(start, stop, chunk_size):
+        labels, features = [], []
+        for entry in xrange(chunk_start, min(chunk_start + chunk_size, stop)):
+            # Only set the current entry, leaving the reading to the TTreeFormulas.
+            tree.LoadTree(entry)
             # This call is ESSENTIAL for formulae whose leaves have variable size.
             sel.GetNdata()
+            if not sel.EvalInstance():
+                continue
             for exp in exps:
                 exp.GetNdata()
             if has_label_exp:
                 label.GetNdata()
-            # Fill the branches for each entry.
-            if sel.EvalInstance():
-                if (save_label == 'file'):
-                    label_address[0] = fnum
-                elif has_label_exp:
-                    label_address[0] = label.EvalInstance()
-                for address, exp in zip(branch_addresses, exps):
-                    address[0] = exp.EvalInstance()
-                root_tree.Fill()
-        # Write the TTree and save the file.
-        root_file.Write()
-        root_file.Close()
+            if (save_label == 'file'):
+                labels.append(fnum)
+            elif has_label_exp:
+                labels.append(label.EvalInstance())
+            features.append([exp.EvalInstance() for exp in exps])
+        if features:
+            yield (numpy.array(labels, dtype=label_type) if save_label else None,
+                   numpy.array(features, dtype=numpy.float64).reshape(-1, len(exps)))
+    f.Close()
+
+
+def iter_feature_chunks(ntuples=[], selection='', feature_dict={}, save_label='file', chunk_size=100000, first_fnum=0):
+    """Evaluate the selection, features, and class labels of the ntuples
+    on chunks of entries using NumPy operations.
+
+    The parameters are those of featurize_ntuple, plus first_fnum, the
+    file number of the first ntuple. The default is 0.
+
+    Yields
+    ------
+    labels : numpy.array or None
+        The class labels of the selected entries in the chunk, or None if
+        save_label is empty. With the default 'file', the labels are the
+        integer index of the ntuple.
+    features : numpy.array of floats
+        The features of the selected entries as an array of shape
+        (n_selected, n_features), ordered as in feature_dict.
+        Chunks without any selected entries are skipped.
+    """
+    for fnum, ntuple in enumerate(expand_ntuples(ntuples), first_fnum):
+        for chunk in _iter_numpy_file_chunks(ntuple, fnum, selection, feature_dict, save_label, chunk_size):
+            yield chunk
+
+
+def _iter_numpy_file_chunks(ntuple, fnum, selection, feature_dict, save_label, chunk_size, start=0, stop=None):
+    """Evaluate a range of entries of a single ntuple using NumPy operations.
+    The file number fnum is the class label when save_label is 'file'.
+
+    Only the branches referenced by the expressions are read. For each
+    chunk, the selection branches are read first, and the remaining
+    branches are only read if any entry passes the selection. The feature
+    and label expressions share a single evaluation plan, so common
+    subexpressions and jet index gathers are computed once per chunk.
+    """
+    sel = numpy_formula.parse(selection) if selection else None
+    exps = [numpy_formula.parse(feature_dict[x]) for x in feature_dict]
+    label = numpy_formula.parse(save_label) if save_label and (save_label != 'file') else None
+    sel_branches = numpy_formula.leaves(sel) if sel is not None else set()
+    other_branches = set()
+    for node in [label] + exps:
+        if node is not None:
+            other_branches |= numpy_formula.leaves(node)
+    other_branches -= sel_branches
+    f = ROOT.TFile.Open(ntuple)
+    tree = f.Get('tree')
+    sizes = numpy_formula.size_branches(tree, sel_branches | other_branches)
+    sel_plan = numpy_formula.EvaluationPlan([sel], sizes) if sel is not None else None
+    plan = numpy_formula.EvaluationPlan(exps + ([label] if label is not None else []), sizes)
+    print '--- Processing %s' % os.path.basename(ntuple)
+    for chunk_start, chunk_stop in numpy_formula.chunk_ranges(tree.GetEntries(), chunk_size, start, stop):
+        # Evaluate the features and labels only for the selected entries.
+        if sel_plan is not None:
+            columns = numpy_formula.read_chunk(tree, sorted(sel_branches), chunk_start, chunk_stop)
+            passed = sel_plan.evaluate_instance(columns)[0].astype(bool)
+            n_selected = numpy.count_nonzero(passed)
+            if not n_selected:
+                continue
+            if other_branches:
+                columns.update(numpy_formula.read_chunk(tree, sorted(other_branches), chunk_start, chunk_stop))
+            columns = numpy_formula.filter_columns(columns, passed)
+        else:
+            columns = numpy_formula.read_chunk(tree, sorted(other_branches), chunk_start, chunk_stop)
+            n_selected = chunk_stop - chunk_start
+        results = plan.evaluate_instance(columns)
+        features = numpy.empty((n_selected, len(exps)), dtype=numpy.float64)
+        for i in xrange(len(exps)):
+            features[:, i] = results[i]
+        if (save_label == 'file'):
+            labels = numpy.full(n_selected, fnum, dtype=numpy.int64)
+        elif label is not None:
+            labels = results[-1].astype(numpy.float64)
+        else:
+            labels = None
+        yield labels, features
+    f.Close()
+
+
+_FILE_ENGINES = {
+    'formula': _iter_formula_file_chunks,
+    'numpy': _iter_numpy_file_chunks,
+}
+
+
+def _iter_chunks(ntuples, selection, feature_dict, save_label, chunk_size, engine, processes, entries_per_task, first_fnum=0):
+    """Dispatch to the serial or parallel chunk iterator of an engine."""
+    if engine not in _FILE_ENGINES:
+        raise ValueError('Unknown featurization engine: {0!r}'.format(engine))
+    if processes and processes > 1:
+        return iter_parallel_chunks(ntuples, selection, feature_dict, save_label, chunk_size,
+                                    engine, processes, entries_per_task, first_fnum)
+    elif engine == 'formula':
+        return iter_formula_chunks(ntuples, selection, feature_dict, save_label, chunk_size, first_fnum)
+    else:
+        return iter_feature_chunks(ntuples, selection, feature_dict, save_label, chunk_size, first_fnum)
+
+
+def _featurize_task(task):
+    """Featurize a range of entries of a single ntuple in a worker process,
+    returning the list of its chunks.
+    """
+    engine, ntuple, fnum, selection, feature_dict, save_label, chunk_size, start, stop = task
+    return list(_FILE_ENGINES[engine](ntuple, fnum, selection, feature_dict, save_label, chunk_size, start, stop))
+
+
+def _imap_bounded(pool, func, iterable, max_pending):
+    """Like pool.imap, yielding results in order, but with at most
+    max_pending tasks submitted at once so memory stays bounded.
+    """
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(pool.apply_async(func, (args,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _count_entries(ntuple):
+    """Return the number of entries of the tree of an ntuple."""
+    f = ROOT.TFile.Open(ntuple)
+    n_entries = f.Get('tree').GetEntries()
+    f.Close()
+    return n_entries
+
+
+def _task_ranges(n_entries, entries_per_task):
+    """Return the (start, stop) entry ranges of the tasks of an ntuple,
+    where an unknown number of entries means a single task.
+    """
+    if n_entries is None:
+        return [(0, None)]
+    return [(start, start + entries_per_task) for start in xrange(0, n_entries, entries_per_task)]
+
+
+def iter_parallel_chunks(ntuples=[], selection='', feature_dict={}, save_label='file', chunk_size=100000,
+                         engine='formula', processes=None, entries_per_task=None, first_fnum=0):
+    """Featurize the ntuples in a pool of worker processes.
+
+    Each ntuple, or range of entries of an ntuple, is processed by its own
+    worker with its file number fixed up front as the class label, rather
+    than relying on TChain.GetTreeNumber. The chunks are yielded in the
+    original order, so the output is the same as for the serial engines.
+
+    Parameters
+    ----------
+    ntuples, selection, feature_dict, save_label, chunk_size, engine
+        As for featurize_ntuple.
+    processes : int, optional
+        The number of worker processes. The default is the number of CPUs.
+    entries_per_task : int, optional
+        The number of entries of an ntuple processed by a single task. It is
+        rounded up to a multiple of chunk_size so that the chunks match the
+        serial run. The entries of each ntuple are counted by the workers,
+        so the first tasks start without opening every ntuple up front.
+        The default is None for a task per ntuple.
+    first_fnum : int, optional
+        The file number of the first ntuple. The default is 0.
+
+    Yields
+    ------
+    labels, features
+        As for iter_feature_chunks.
+    """
+    if entries_per_task:
+        entries_per_task = -(-entries_per_task // chunk_size) * chunk_size
+    ntuples = expand_ntuples(ntuples)
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+        if entries_per_task:
+            # The tasks of an ntuple are created as soon as a worker has counted its entries.
+            n_entries = pool.imap(_count_entries, ntuples)
+        else:
+            n_entries = itertools.repeat(None)
+        tasks = (
+            (engine, ntuple, fnum, selection, feature_dict, save_label, chunk_size, start, stop)
+            for fnum, (ntuple, n) in enumerate(itertools.izip(ntuples, n_entries), first_fnum)
+            for start, stop in _task_ranges(n, entries_per_task)
+        )
+        for chunks in _imap_bounded(pool, _featurize_task, tasks, 2 * processes):
+            for chunk in chunks:
+                yield chunk
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _read_ahead(iterable):
+    """Iterate over an iterable in a background thread, which reads the
+    next item while the caller works on the current one.
+
+    An exception raised by the iterable is raised again in the caller,
+    and the thread stops once the caller stops iterating.
+    """
+    queue = Queue.Queue(maxsize=1)
+    stopped = threading.Event()
+
+    def put(message):
+        # Time out regularly to notice that the caller stopped iterating.
+        while not stopped.is_set():
+            try:
+                queue.put(message, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(('item', item)):
+                    return
+        except Exception:
+            put(('error', sys.exc_info()))
+        else:
+            put(('done', None))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            kind, value = queue.get()
+            if kind == 'done':
+                return
+            if kind == 'error':
+                raise value[0], value[1], value[2]
+            yield value
+    finally:
+        stopped.set()
+
+
+def iter_batches(ntuples=[], selection='', feature_dict={}, save_label='file', batch_size=1024,
+                 engine='numpy', chunk_size=100000, processes=None, entries_per_task=None, dtype=numpy.float32):
+    """Stream (X, y) batches straight from the ntuples, without an intermediate file.
+
+    The next chunk is read while the caller consumes the batches of the
+    current one: by a background thread in a serial run or, with processes
+    greater than one, by the workers, which each featurize a single chunk
+    per task by default and read ahead by at most two chunks each. So
+    memory stays bounded, and training can start on the first batch while
+    the rest of the ntuples are still being read.
+
+    Parameters
+    ----------
+    ntuples, selection, feature_dict, save_label
+        As for featurize_ntuple.
+    batch_size : int, optional
+        The number of examples per batch. The last batch may be smaller.
+        The default is 1024.
+    engine, chunk_size, processes, entries_per_task
+        As for featurize_ntuple, except that the default engine is 'numpy'
+        and entries_per_task defaults to chunk_size, for a task per chunk.
+    dtype : numpy.dtype, optional
+        The data type of the feature batches. The default is numpy.float32.
+
+    Yields
+    ------
+    X : numpy.array
+        The features as an array of shape (batch_size, n_features).
+    y : numpy.array or None
+        The class labels as an array of shape (batch_size,),
+        or None if save_label is empty.
+    """
+    chunks = _iter_chunks(ntuples, selection, feature_dict, save_label, chunk_size, engine, processes,
+                          entries_per_task or chunk_size)
+    if not (processes and processes > 1):
+        chunks = _read_ahead(chunks)
+    # Buffer the chunks until there are enough examples for a batch.
+    buffered_labels, buffered_features, n_buffered = [], [], 0
+    for labels, features in chunks:
+        buffered_labels.append(labels)
+        buffered_features.append(features.astype(dtype))
+        n_buffered += len(features)
+        if n_buffered < batch_size:
+            continue
+        X = numpy.concatenate(buffered_features)
+        y = numpy.concatenate(buffered_labels) if save_label else None
+        n_batches = len(X) // batch_size
+        for i in xrange(n_batches):
+            batch = slice(i * batch_size, (i + 1) * batch_size)
+            yield X[batch], (y[batch] if y is not None else None)
+        remainder = slice(n_batches * batch_size, None)
+        buffered_features = [X[remainder]]
+        buffered_labels = [y[remainder] if y is not None else None]
+        n_buffered = len(buffered_features[0])
+    if n_buffered:
+        X = numpy.concatenate(buffered_features)
+        y = numpy.concatenate(buffered_labels) if save_label else None
+        yield X, y
+
+
+# The numpy types corresponding to the ROOT data type initials of the feature names.
+ROOT_TO_NUMPY_TYPE = {'I': numpy.int32, 'F': numpy.float32, 'D': numpy.float64}
+
+
+def _output_extension(path):
+    """Return the extension of an output path, ignoring any trailing slash."""
+    return os.path.splitext(path.rstrip('/'))[1]
+
+
+def output_dtype(feature_dict, save_label):
+    """Return the structured dtype of an output row. The fields are named
+    like the branches of the .root output, with the class label first.
+    """
+    dtype = [(x[:-2], ROOT_TO_NUMPY_TYPE[x[-1]]) for x in feature_dict]
+    if save_label:
+        dtype.insert(0, ('Class', numpy.int32))
+    return numpy.dtype(dtype)
+
+
+class _OutputWriter(object):
+    """The base class of the featurize_ntuple output writers, which receive
+    the labels and features a chunk at a time.
+
+    Parameters
+    ----------
+    path : path
+        The path to the output file.
+    feature_dict : collections.OrderedDict
+        The feature names and expressions, as for featurize_ntuple.
+    save_label : string
+        The class label expression, as for featurize_ntuple.
+    header : bool, optional
+        Whether a header line is written. Only used by the .csv output.
+    append : bool, optional
+        Whether the rows are appended to an existing output.
+        The default is False to overwrite it.
+    """
+    def __init__(self, path, feature_dict, save_label, header=True, append=False):
+        self.path = path
+        self.feature_dict = feature_dict
+        self.save_label = save_label
+        self.dtype = output_dtype(feature_dict, save_label)
+        self.n_rows = 0
+
+    def _records(self, labels, features):
+        """Convert a chunk to a structured array of self.dtype."""
+        records = numpy.empty(len(features), dtype=self.dtype)
+        if self.save_label:
+            records['Class'] = labels
+        for i, x in enumerate(self.feature_dict):
+            records[x[:-2]] = features[:, i]
+        return records
+
+    def manifest(self):
+        """Describe the columns and number of rows of the output."""
+        names = (['Class/I'] if self.save_label else []) + list(self.feature_dict)
+        expressions = ([self.save_label] if self.save_label else []) + list(self.feature_dict.values())
+        return {
+            'rows': self.n_rows,
+            'columns': [
+                {'name': name, 'field': field, 'dtype': self.dtype[field].str, 'expression': expression}
+                for name, field, expression in zip(names, self.dtype.names, expressions)
+            ],
+        }
+
+    def _write_manifest(self, path, **extra):
+        manifest = self.manifest()
+        manifest.update(extra)
+        with open(path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+    def write(self, labels, features):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CsvWriter(_OutputWriter):
+    """Write the rows as a .csv file."""
+    def __init__(self, path, feature_dict, save_label, header=True, append=False):
+        super(CsvWriter, self).__init__(path, feature_dict, save_label)
+        self._file = open(path, 'a' if append else 'w')
+        self._writer = csv.writer(self._file)
+        # Header Row
+        if header and not append:
+            if save_label:
+                self._writer.writerow(['Class/I'] + [x for x in feature_dict])
+            else:
+                self._writer.writerow([x for x in feature_dict])
+
+    def write(self, labels, features):
+        if labels is None:
+            self._writer.writerows(features.tolist())
+        else:
+            self._writer.writerows([label] + row for label, row in zip(labels.tolist(), features.tolist()))
+        self.n_rows += len(features)
+
+    def close(self):
+        self._file.close()
+
+
+class RootWriter(_OutputWriter):
+    """Write the rows as the TTree "features" of a .root file."""
+    def __init__(self, path, feature_dict, save_label, header=True, append=False):
+        super(RootWriter, self).__init__(path, feature_dict, save_label)
+        if append:
+            self._file = ROOT.TFile(path, 'UPDATE')
+            self._tree = self._file.Get('features')
+            self.n_rows = self._tree.GetEntries()
+        else:
+            self._file = ROOT.TFile(path, 'RECREATE')
+            self._tree = None
+
+    def write(self, labels, features):
+        self._file.cd()
+        self._tree = root_numpy.array2tree(self._records(labels, features), name='features', tree=self._tree)
+        self.n_rows += len(features)
+
+    def close(self):
+        if self._tree is None:
+            self.write(numpy.zeros(0), numpy.zeros((0, len(self.feature_dict))))
+        # Write the TTree and save the file, replacing the previous
+        # TTree when appending rather than adding a new cycle.
+        self._file.Write('', ROOT.TObject.kOverwrite)
+        self._file.Close()
+
+
+class NpyWriter(_OutputWriter):
+    """Write the rows as a structured array in a .npy file, which can be
+    memory-mapped. A sidecar manifest, named after the output with the
+    suffix .json, describes the columns.
+    """
+    def __init__(self, path, feature_dict, save_label, header=True, append=False):
+        super(NpyWriter, self).__init__(path, feature_dict, save_label)
+        self._appender = NpyAppender(path, self.dtype, mode='a' if append else 'w')
+        self.n_rows = self._appender.n_rows
+
+    def write(self, labels, features):
+        self._appender.write(self._records(labels, features))
+        self.n_rows += len(features)
+
+    def close(self):
+        self._appender.close()
+        self._write_manifest(self.path + '.json', format='npy')
+
+
+class NpzWriter(_OutputWriter):
+    """Write each column as an array in a .npz file. A sidecar manifest,
+    named after the output with the suffix .json, describes the columns.
+    As the .npz format can't be appended to, the chunks are kept in memory
+    until the writer is closed, and appending is not supported.
+    """
+    def __init__(self, path, feature_dict, save_label, header=True, append=False):
+        if append:
+            raise ValueError('Cannot append to {0}, use the .npy or .columns format instead'.format(path))
+        super(NpzWriter, self).__init__(path, feature_dict, save_label)
+        self._chunks = []
+
+    def write(self, labels, features):
+        self._chunks.append(self._records(labels, features))
+        self.n_rows += len(features)
+
+    def close(self):
+        records = numpy.concatenate(self._chunks) if self._chunks else numpy.zeros(0, dtype=self.dtype)
+        numpy.savez(self.path, **dict((field, records[field]) for field in self.dtype.names))
+        self._write_manifest(self.path + '.json', format='npz')
+
+
+class ColumnarWriter(_OutputWriter):
+    """Write the rows in a chunked columnar format: a directory holding
+    a .npy file per column, each of which can be memory-mapped, and a
+    manifest.json describing the columns and the chunk boundaries.
+    Use load_columns to open the output.
+    """
+    def __init__(self, path, feature_dict, save_label, header=True, append=False):
+        super(ColumnarWriter, self).__init__(path, feature_dict, save_label)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._appenders = [
+            NpyAppender(os.path.join(path, field + '.npy'), self.dtype[field], mode='a' if append else 'w')
+            for field in self.dtype.names
+        ]
+        self._chunks = []
+        if append:
+            with open(os.path.join(path, 'manifest.json')) as f:
+                manifest = json.load(f)
+            self._chunks = manifest['chunks']
+            self.n_rows = manifest['rows']
+
+    def write(self, labels, features):
+        if not len(features):
+            return
+        records = self._records(labels, features)
+        for field, appender in zip(self.dtype.names, self._appenders):
+            appender.write(records[field])
+        self._chunks.append(len(features))
+        self.n_rows += len(features)
+
+    def close(self):
+        for appender in self._appenders:
+            appender.close()
+        self._write_manifest(os.path.join(self.path, 'manifest.json'), format='columns', chunks=self._chunks)
+
+
+OUTPUT_WRITERS = {
+    '.csv': CsvWriter,
+    '.root': RootWriter,
+    '.npy': NpyWriter,
+    '.npz': NpzWriter,
+    '.columns': ColumnarWriter,
+}
+
+
+def load_columns(path, mmap_mode='r'):
+    """Open the output of featurize_ntuple in the chunked columnar format.
+
+    Parameters
+    ----------
+    path : path
+        The path to the .columns directory.
+    mmap_mode : string, optional
+        The memory-map mode passed to numpy.load. The default is 'r'.
+
+    Returns
+    -------
+    columns : collections.OrderedDict
+        The memory-mapped arrays by feature name, e.g. 'Pt_V/F'.
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    return collections.OrderedDict(
+        (column['name'], numpy.load(os.path.join(path, column['field'] + '.npy'), mmap_mode=mmap_mode))
+        for column in manifest['columns']
+    )
 
 
 def main():
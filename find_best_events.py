@@ -1,6 +1,14 @@
 #!/usr/bin/env python
+import collections
+
+import numpy
+import pandas
 import root_pandas
 
+import numpy_formula
+from column_cache import ColumnCache
+from numpy_formula import TreeReader
+
 
 class BestEventsFinder(object):
     """Find the best signal region events for each channel by DNN score.
@@ -11,6 +19,13 @@ class BestEventsFinder(object):
 
     Note: The best events are those with the lowest scores because of the
     values contained in the branch are before the "(1 - DNN)" transformation.
+
+    Parameters
+    ----------
+    cache : column_cache.ColumnCache, optional
+        A local cache of the branches read by find_all and cut_flow, so
+        that repeated queries don't read the ntuples again. The default
+        is to always read the ntuples.
     """
 
     GENERIC_SR = 'Pass_nominal && usingBEnriched && Jet_bReg[hJetInd1]>25 && Jet_bReg[hJetInd2]>25 && controlSample==0'
@@ -23,9 +38,23 @@ class BestEventsFinder(object):
         'Zmm': 'isZmm && V_pt>50 && hJets_btagged_0>-0.5884 && hJets_btagged_1>-0.5884 && H_mass_fit_fallback>90 && H_mass_fit_fallback<150',
     }   
 
-    def __call__(self, path, channel, branch):
+    def __init__(self, cache=None):
+        self.cache = cache
+
+    def _open(self, path, branches):
+        """Return a reader of the given branches of the Events tree."""
+        if self.cache is not None:
+            return self.cache.open(path, 'Events', branches)
+        return TreeReader(path, 'Events')
+
+    def __call__(self, path, channel, branch, k=5, chunksize=100000):
         """Report the best events by DNN score.
 
+        The ntuple is read in chunks and only the k best events seen so far
+        are kept between chunks, so memory usage is independent of the
+        number of events passing the selection. Events with equal scores
+        keep their order in the ntuple.
+
         Parameters
         ----------
         path : path
@@ -39,6 +68,16 @@ class BestEventsFinder(object):
               * Zmm
         branch : string
             The name of the DNN branch used to score events.
+        k : int, optional
+            The number of best events to report. The default is 5.
+        chunksize : int, optional
+            The number of entries read per chunk. The default is 100000.
+
+        Returns
+        -------
+        best : pandas.DataFrame
+            The k best events sorted by score, with their run, luminosity
+            block, and event numbers.
         """
         # Form the signal region event selection by combining
         # the generic and channel specific selections.
@@ -46,11 +85,153 @@ class BestEventsFinder(object):
 
         # The list of columns to include in the dataframe.
         columns = [branch, 'run', 'luminosityBlock', 'event']
-        df = (
-            root_pandas.read_root(path, key='Events', columns=columns, where=selection)
-                       .sort_values(by=branch, kind='mergesort')
+        chunks = root_pandas.read_root(path, key='Events', columns=columns, where=selection, chunksize=chunksize)
+        best = None
+        for chunk in chunks:
+            # The current best events precede the chunk, so keep='first'
+            # resolves ties in favour of the earlier events like a stable sort.
+            if best is not None:
+                chunk = pandas.concat([best, chunk], ignore_index=True)
+            best = chunk.nsmallest(k, branch, keep='first')
+        if best is None:
+            best = pandas.DataFrame(columns=columns)
+        best = best.reset_index(drop=True)
+        print best
+        return best
+
+    def find_all(self, tasks, k=5, chunk_size=100000):
+        """Report the best events for several tasks, reading each ntuple once.
+
+        The tasks are grouped by ntuple. For each ntuple, the union of the
+        branches needed by its tasks is read in a single pass over chunks
+        of entries. The generic signal region selection is evaluated once
+        per chunk, and the remaining branches are only read for chunks
+        where some entry passes it. Each channel selection is evaluated
+        once per chunk no matter how many DNN branches share it.
+
+        Parameters
+        ----------
+        tasks : list of tuples
+            The (path, channel, branch) tasks as accepted by __call__.
+        k : int, optional
+            The number of best events to report per task. The default is 5.
+        chunk_size : int, optional
+            The number of entries read per chunk. The default is 100000.
+
+        Returns
+        -------
+        best : dict
+            The k best events sorted by score as a pandas.DataFrame,
+            keyed by the (path, channel, branch) task.
+        """
+        groups = collections.OrderedDict()
+        for path, channel, branch in tasks:
+            groups.setdefault(path, []).append((channel, branch))
+        best = {}
+        for path, group in groups.iteritems():
+            for (channel, branch), df in self._find_in_file(path, group, k, chunk_size).iteritems():
+                best[path, channel, branch] = df
+        return best
+
+    def _find_in_file(self, path, group, k, chunk_size):
+        """Find the best events for the (channel, branch) pairs of one ntuple."""
+        generic = numpy_formula.parse(self.GENERIC_SR)
+        channels = sorted(set(channel for channel, _ in group))
+        selections = [numpy_formula.parse(self.CHANNEL_SR[channel]) for channel in channels]
+        event_branches = ['run', 'luminosityBlock', 'event']
+        generic_branches = numpy_formula.leaves(generic)
+        other_branches = set(branch for _, branch in group) | set(event_branches)
+        for node in selections:
+            other_branches |= numpy_formula.leaves(node)
+        other_branches -= generic_branches
+        reader = self._open(path, generic_branches | other_branches)
+        sizes = reader.size_branches(generic_branches | other_branches)
+        generic_plan = numpy_formula.EvaluationPlan([generic], sizes)
+        channel_plan = numpy_formula.EvaluationPlan(selections, sizes)
+        # The running best events per task, as (score, entry, run, lumi, event) arrays.
+        best = dict((task, None) for task in group)
+        for start, stop in numpy_formula.chunk_ranges(reader.n_entries, chunk_size):
+            columns = reader.read(sorted(generic_branches), start, stop)
+            passed = generic_plan.evaluate_instance(columns)[0].astype(bool)
+            if not passed.any():
+                continue
+            columns.update(reader.read(sorted(other_branches), start, stop))
+            columns = numpy_formula.filter_columns(columns, passed)
+            entries = numpy.flatnonzero(passed) + start
+            masks = dict(zip(channels, channel_plan.evaluate_instance(columns)))
+            for channel, branch in group:
+                mask = masks[channel].astype(bool)
+                candidates = [columns[branch][mask], entries[mask]] + [columns[x][mask] for x in event_branches]
+                if best[channel, branch] is not None:
+                    candidates = [numpy.concatenate(pair) for pair in zip(best[channel, branch], candidates)]
+                # The candidates are in entry order, so a stable sort
+                # resolves ties in favour of the earlier events.
+                order = numpy.argsort(candidates[0], kind='mergesort')[:k]
+                best[channel, branch] = [x[order] for x in candidates]
+        reader.close()
+        results = {}
+        for channel, branch in group:
+            df = pandas.DataFrame(columns=[branch] + event_branches)
+            if best[channel, branch] is not None:
+                score, _, run, lumi, event = best[channel, branch]
+                df = pandas.DataFrame(collections.OrderedDict(zip(df.columns, (score, run, lumi, event))))
+            results[channel, branch] = df
+        return results
+
+
+    def cut_flow(self, path, channel, chunk_size=100000):
+        """Report the cut flow of a channel's signal region selection.
+
+        The generic and channel specific selections are split into their
+        component cuts, which are evaluated as boolean masks over chunks
+        of entries in a single pass over the ntuple. For each cut, the
+        sequential count is the number of events passing it and all the
+        preceding cuts, and the N-1 count is the number of events passing
+        all the other cuts.
+
+        Parameters
+        ----------
+        path : path
+            The XRootD url to an AnalysisTools ntuple.
+        channel : string
+            The channel name which specifies the signal region selection,
+            as accepted by __call__.
+        chunk_size : int, optional
+            The number of entries read per chunk. The default is 100000.
+
+        Returns
+        -------
+        flow : pandas.DataFrame
+            The sequential and N-1 counts indexed by cut.
+        """
+        cuts = (
+            numpy_formula.conjuncts(numpy_formula.parse(self.GENERIC_SR)) +
+            numpy_formula.conjuncts(numpy_formula.parse(self.CHANNEL_SR[channel]))
+        )
+        branches = set().union(*[numpy_formula.leaves(cut) for cut in cuts])
+        reader = self._open(path, branches)
+        plan = numpy_formula.EvaluationPlan(cuts, reader.size_branches(branches))
+        n_entries = 0
+        sequential = numpy.zeros(len(cuts), dtype=numpy.int64)
+        n_minus_one = numpy.zeros(len(cuts), dtype=numpy.int64)
+        for start, stop in numpy_formula.chunk_ranges(reader.n_entries, chunk_size):
+            columns = reader.read(sorted(branches), start, stop)
+            masks = numpy.array([mask.astype(bool) for mask in plan.evaluate_instance(columns)])
+            n_entries += masks.shape[1]
+            sequential += numpy.logical_and.accumulate(masks, axis=0).sum(axis=1)
+            # An event contributes to the N-1 count of a cut if it fails
+            # no cut at all, or if that cut is the only one it fails.
+            n_failed = numpy.count_nonzero(~masks, axis=0)
+            n_minus_one += numpy.count_nonzero(n_failed == 0)
+            n_minus_one += numpy.count_nonzero(~masks & (n_failed == 1), axis=1)
+        reader.close()
+        flow = pandas.DataFrame(
+            collections.OrderedDict([('sequential', sequential), ('n_minus_one', n_minus_one)]),
+            index=pandas.Index([numpy_formula.to_string(cut) for cut in cuts], name='cut'),
         )
-        print df.head()
+        print 'Cut flow of {0} entries for channel {1}'.format(n_entries, channel)
+        print flow
+        return flow
 
 
 if __name__ == '__main__':
@@ -66,10 +247,14 @@ if __name__ == '__main__':
         ('sum_Run2017_DoubleMu_ReMiniAOD.root',  'Zmm', 'CMS_vhbb_DNN_Zll_HighPT_13TeV'),
     ]
 
-    find_best_events = BestEventsFinder()
+    find_best_events = BestEventsFinder(cache=ColumnCache())
+
+    # Tasks sharing an ntuple are read together in a single pass.
+    url = 'root://cmseos.fnal.gov//store/group/lpchbb/VHbbAnalysisNtuples/2017V5_June19_unblinding/haddjobs/{0}'
+    tasks = [(url.format(filename), channel, branch) for filename, channel, branch in tasks]
+    best = find_best_events.find_all(tasks)
 
-    for filename, channel, branch in tasks:
-        print 'The five best events from {0} for channel {1} as scored by {2} are...'.format(filename, channel, branch)
-        path = 'root://cmseos.fnal.gov//store/group/lpchbb/VHbbAnalysisNtuples/2017V5_June19_unblinding/haddjobs/{0}'.format(filename)
-        find_best_events(path, channel, branch)
+    for path, channel, branch in tasks:
+        print 'The five best events from {0} for channel {1} as scored by {2} are...'.format(path.rsplit('/', 1)[-1], channel, branch)
+        print best[path, channel, branch]
         print '\n'
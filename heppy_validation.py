@@ -1,21 +1,263 @@
 from __future__ import absolute_import
 
+import hashlib
 import logging
+import multiprocessing
 import os
 import uuid
 
+import numpy
 from rootpy import ROOT
 from rootpy.io import root_open
 from rootpy.plotting import Canvas, Hist, HistStack, Legend
 
 from Xbb.utils import path
 
+import atomic_files
+import numpy_formula
+from numpy_formula import TreeReader
+
 # Set ROOT to batch mode.
 ROOT.gROOT.SetBatch(True)
 
 LOGGER = logging.getLogger(__name__)
 
 
+class EventIndex(object):
+    """An index from (run, lumi, event) to tree entry for a sample.
+
+    The event IDs are stored as two uint64 keys, (run << 32 | lumi) and the
+    event number, sorted lexicographically along with their entries. The
+    entries of the events common to two samples are then found with one
+    sort of the concatenated keys, which takes seconds for millions of
+    events.
+
+    Parameters
+    ----------
+    high, low : numpy.array of uint64
+        The (run << 32 | lumi) and event number keys in sorted order.
+    entries : numpy.array of int64
+        The tree entry of each key.
+    """
+    BRANCHES = ('run', 'lumi', 'evt')
+
+    def __init__(self, high, low, entries):
+        self.high = high
+        self.low = low
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def build(cls, sample, tree='tree', chunk_size=1000000):
+        """Build the index of a sample by reading its event ID branches."""
+        reader = TreeReader(sample, tree)
+        high = numpy.empty(reader.n_entries, dtype=numpy.uint64)
+        low = numpy.empty(reader.n_entries, dtype=numpy.uint64)
+        for start, stop in numpy_formula.chunk_ranges(reader.n_entries, chunk_size):
+            columns = reader.read(cls.BRANCHES, start, stop)
+            run, lumi, evt = [columns[x].astype(numpy.uint64) for x in cls.BRANCHES]
+            high[start:stop] = (run << numpy.uint64(32)) | lumi
+            low[start:stop] = evt
+        reader.close()
+        entries = numpy.lexsort((low, high))
+        high, low = high[entries], low[entries]
+        duplicate = numpy.zeros(len(entries), dtype=bool)
+        duplicate[1:] = (high[1:] == high[:-1]) & (low[1:] == low[:-1])
+        if duplicate.any():
+            # Keep the first entry of each event so that matches are unique.
+            LOGGER.warning('Dropping %d duplicate events from the index of %s', duplicate.sum(), sample)
+            keep = ~duplicate
+            high, low, entries = high[keep], low[keep], entries[keep]
+        return cls(high, low, entries.astype(numpy.int64))
+
+    @staticmethod
+    def _identity(sample):
+        """Return the modification time of a local sample, or zero for a remote one."""
+        return os.stat(sample).st_mtime if os.path.exists(sample) else 0.0
+
+    @classmethod
+    def load(cls, sample, directory, tree='tree'):
+        """Return the index of a sample, building and saving it if needed.
+
+        The index of a local sample is saved next to it as <sample>.evtidx.npz
+        and rebuilt whenever the sample is modified. The index of a remote
+        sample is saved in the given directory under the hash of its url.
+        """
+        if os.path.exists(sample):
+            index_path = sample + '.evtidx.npz'
+        else:
+            path.safe_makedirs(directory)
+            index_path = os.path.join(directory, hashlib.sha1(sample).hexdigest() + '.evtidx.npz')
+        identity = cls._identity(sample)
+        if os.path.isfile(index_path):
+            with numpy.load(index_path) as cached:
+                if cached['identity'] == identity:
+                    LOGGER.debug('Loading the event index of %s from %s', sample, index_path)
+                    return cls(cached['high'], cached['low'], cached['entries'])
+        LOGGER.debug('Building the event index of %s', sample)
+        index = cls.build(sample, tree)
+        atomic_files.write_atomically(
+            index_path,
+            lambda f: numpy.savez(f, high=index.high, low=index.low, entries=index.entries, identity=identity),
+            mode='wb',
+        )
+        return index
+
+    def match(self, other):
+        """Return the entries of the events common to both indices, as a
+        pair of arrays of entries into this sample and the other sample.
+        """
+        high = numpy.concatenate([self.high, other.high])
+        low = numpy.concatenate([self.low, other.low])
+        # Within an event, this sample's key sorts before the other's.
+        source = numpy.repeat([0, 1], [len(self), len(other)])
+        order = numpy.lexsort((source, low, high))
+        high, low = high[order], low[order]
+        same = (high[1:] == high[:-1]) & (low[1:] == low[:-1])
+        first, second = order[:-1][same], order[1:][same] - len(self)
+        return self.entries[first], other.entries[second]
+
+
+# The leaf types of the branches checked by the automated validation.
+NUMERIC_TYPES = {
+    'Bool_t', 'Char_t', 'UChar_t', 'Short_t', 'UShort_t', 'Int_t', 'UInt_t',
+    'Long64_t', 'ULong64_t', 'Float_t', 'Double_t',
+}
+
+
+def numeric_branches(sample, tree='tree'):
+    """Return the names of the branches of a sample holding a single numeric leaf."""
+    reader = TreeReader(sample, tree)
+    names = set()
+    for branch in reader.tree.GetListOfBranches():
+        leaves = branch.GetListOfLeaves()
+        if leaves.GetEntries() == 1 and leaves.At(0).GetTypeName() in NUMERIC_TYPES:
+            names.add(branch.GetName())
+    reader.close()
+    return names
+
+
+def _branch_values(columns, name):
+    """Return the finite values of a column, with every element of a variable size branch."""
+    column = columns[name]
+    values = column.content if isinstance(column, numpy_formula.JaggedColumn) else column
+    values = numpy.asarray(values, dtype=numpy.float64)
+    return values[numpy.isfinite(values)]
+
+
+def quantile_histograms(values_old, values_new, n_bins=50):
+    """Histogram pairs of samples in bins of equal population in the old sample.
+
+    The bin edges are the distinct quantiles of the old values, with open
+    bins below and above them so that no new value falls outside. The
+    counts are padded with empty bins to a common number of bins.
+
+    Returns
+    -------
+    counts_old, counts_new : numpy.array
+        The counts as arrays of shape (n_variables, n_bins + 2).
+    """
+    counts_old = numpy.zeros((len(values_old), n_bins + 2))
+    counts_new = numpy.zeros((len(values_new), n_bins + 2))
+    for i, (old, new) in enumerate(zip(values_old, values_new)):
+        if len(old):
+            edges = numpy.unique(numpy.percentile(old, numpy.linspace(0, 100, n_bins + 1)))
+        else:
+            edges = numpy.unique(numpy.percentile(new, numpy.linspace(0, 100, n_bins + 1))) if len(new) else numpy.zeros(1)
+        for counts, x in ((counts_old, old), (counts_new, new)):
+            counts[i, :len(edges) + 1] = numpy.bincount(numpy.searchsorted(edges, x, side='right'), minlength=len(edges) + 1)
+    return counts_old, counts_new
+
+
+def ks_test(counts_old, counts_new):
+    """Return the binned Kolmogorov-Smirnov distance and its asymptotic
+    p-value for each row of two arrays of histogram counts. A variable
+    filled in only one version has distance one and p-value zero.
+    """
+    n_old = counts_old.sum(axis=1)
+    n_new = counts_new.sum(axis=1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        cdf_old = numpy.cumsum(counts_old, axis=1) / n_old[:, numpy.newaxis]
+        cdf_new = numpy.cumsum(counts_new, axis=1) / n_new[:, numpy.newaxis]
+        distance = numpy.nan_to_num(numpy.abs(cdf_old - cdf_new).max(axis=1))
+        effective = numpy.nan_to_num(n_old * n_new / (n_old + n_new))
+    # A variable filled in only one version is maximally different.
+    one_sided = (n_old > 0) != (n_new > 0)
+    distance = numpy.where(one_sided, 1., distance)
+    # The Kolmogorov distribution Q(x) = 2 sum_j (-1)^(j-1) exp(-2 j^2 x^2).
+    x = distance * numpy.sqrt(effective)
+    j = numpy.arange(1, 101)[:, numpy.newaxis]
+    p_value = 2 * numpy.sum((-1.) ** (j - 1) * numpy.exp(-2 * j ** 2 * x ** 2), axis=0)
+    # The series converges poorly for small x, where the p-value is one.
+    p_value = numpy.where(x < 0.2, 1., numpy.clip(p_value, 0, 1))
+    return distance, numpy.where(one_sided, 0., p_value)
+
+
+def chi2_test(counts_old, counts_new):
+    """Return the chi2 per degree of freedom comparing the shapes of each
+    row of two arrays of histogram counts, ignoring bins empty in both.
+    A variable filled in only one version has an infinite chi2.
+    """
+    n_old = counts_old.sum(axis=1)[:, numpy.newaxis]
+    n_new = counts_new.sum(axis=1)[:, numpy.newaxis]
+    total = counts_old + counts_new
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        terms = (numpy.sqrt(n_new / n_old) * counts_old - numpy.sqrt(n_old / n_new) * counts_new) ** 2 / total
+    terms = numpy.where(total > 0, terms, 0)
+    ndf = numpy.count_nonzero(total, axis=1) - 1
+    chi2 = numpy.nan_to_num(terms.sum(axis=1) / numpy.maximum(ndf, 1))
+    one_sided = (n_old[:, 0] > 0) != (n_new[:, 0] > 0)
+    return numpy.where(one_sided, numpy.inf, chi2)
+
+
+def _auto_validate_task(task):
+    """Compare every shared numeric branch of a pair of samples."""
+    label, sample_old, sample_new, n_bins, max_entries, group_size = task
+    branches = sorted(numeric_branches(sample_old) & numeric_branches(sample_new))
+    LOGGER.info('Comparing %d shared branches for %s', len(branches), label)
+    rows = []
+    readers = [TreeReader(sample, 'tree') for sample in (sample_old, sample_new)]
+    # Read the branches in groups to bound the memory usage.
+    for i in xrange(0, len(branches), group_size):
+        group = branches[i:i + group_size]
+        columns = [reader.read(group, 0, min(reader.n_entries, max_entries)) for reader in readers]
+        values = [[_branch_values(chunk, name) for name in group] for chunk in columns]
+        counts_old, counts_new = quantile_histograms(values[0], values[1], n_bins)
+        distance, p_value = ks_test(counts_old, counts_new)
+        chi2 = chi2_test(counts_old, counts_new)
+        for j, name in enumerate(group):
+            rows.append((label, name, distance[j], p_value[j], chi2[j]))
+    for reader in readers:
+        reader.close()
+    return rows
+
+
+def sample_clusters(tree, fraction, seed=None):
+    """Return a random subset of the clusters of a tree as (start, stop)
+    entry ranges in increasing order, merging adjacent clusters. Reading
+    whole clusters means the baskets of the skipped entries are never read.
+    """
+    n_entries = tree.GetEntries()
+    clusters = []
+    iterator = tree.GetClusterIterator(0)
+    start = iterator()
+    while start < n_entries:
+        clusters.append((start, min(iterator.GetNextEntry(), n_entries)))
+        start = iterator()
+    n_chosen = max(1, int(round(fraction * len(clusters)))) if clusters else 0
+    chosen = numpy.sort(numpy.random.RandomState(seed).choice(len(clusters), n_chosen, replace=False))
+    ranges = []
+    for i in chosen:
+        start, stop = clusters[i]
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
+    return ranges
+
+
 class HeppyValidationPlot(object):
 
     def __init__(self, version_old, version_new):
@@ -42,6 +284,289 @@ class HeppyValidationPlot(object):
             h.SetTitle(title)
             return h
 
+    def validate(self, sample_old, sample_new, plots, chunk_size=100000):
+        """Draw every plot while reading each sample only once.
+
+        Equivalent to calling the instance for each plot, but rather than
+        a TTree.Draw per plot and sample, the branches needed by all plots
+        are read in chunks and every histogram is filled in a single pass.
+
+        Parameters
+        ----------
+        sample_old, sample_new : path
+            The paths or XRootD urls of the old and new samples.
+        plots : dict
+            The plot options by name, as passed to __call__.
+        chunk_size : int, optional
+            The number of entries read at a time. The default is 100000.
+        """
+        hists_old = self.get_histograms(sample_old, self.version_old, plots, chunk_size)
+        hists_new = self.get_histograms(sample_new, self.version_new, plots, chunk_size)
+        for name, options in plots.iteritems():
+            h_old, h_new = hists_old[name], hists_new[name]
+            h_old.legendstyle = 'l'
+            h_new.legendstyle = 'l'
+            h_stack = self.make_stack(h_old, h_new)
+            self.draw(h_stack, name, **options)
+
+    def validate_sampled(self, sample_old, sample_new, plots, fraction=0.1, seed=None, n_sigma=3., chunk_size=100000):
+        """Draw every plot from a random subset of the clusters of each sample.
+
+        Like validate(), but only a fraction of each sample is read, in
+        whole clusters so that the skipped baskets are never read. The
+        plots are drawn with their per-bin statistical uncertainties, and
+        the bins where the normalized old and new contents differ by more
+        than n_sigma standard deviations are flagged in the log and in
+        sampled_validation.txt in the destination directory.
+
+        Parameters
+        ----------
+        sample_old, sample_new : path
+            The paths or XRootD urls of the old and new samples.
+        plots : dict
+            The plot options by name, as passed to __call__.
+        fraction : float, optional
+            The fraction of the clusters of each sample read. The default is 0.1.
+        seed : int, optional
+            The seed from which the random choices of clusters of both
+            samples are derived. Each sample gets its own choice.
+        n_sigma : float, optional
+            The pull above which a bin is flagged. The default is 3.
+        chunk_size : int, optional
+            The maximum number of entries read at a time. The default is 100000.
+
+        Returns
+        -------
+        flagged : dict
+            The bin numbers and pulls of the flagged bins of each plot by name.
+        """
+        # Choose the clusters of each sample independently, as the pulls assume
+        # uncorrelated samples, but reproducibly from the one seed.
+        seed_old, seed_new = numpy.random.RandomState(seed).randint(2 ** 31, size=2)
+        hists_old = self.get_histograms(sample_old, self.version_old, plots, chunk_size, fraction, seed_old)
+        hists_new = self.get_histograms(sample_new, self.version_new, plots, chunk_size, fraction, seed_new)
+        flagged = {}
+        lines = ['{0} vs {1} from {2:.0%} of the clusters, flagging pulls above {3}'.format(self.version_old, self.version_new, fraction, n_sigma)]
+        for name, options in sorted(plots.iteritems()):
+            h_old, h_new = hists_old[name], hists_new[name]
+            bins = numpy.arange(1, h_old.GetNbinsX() + 1)
+            contents = [numpy.array([h.GetBinContent(int(i)) for i in bins]) for h in (h_old, h_new)]
+            errors = [numpy.array([h.GetBinError(int(i)) for i in bins]) for h in (h_old, h_new)]
+            sigma = numpy.hypot(*errors)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                pulls = numpy.where(sigma > 0, (contents[1] - contents[0]) / sigma, 0.)
+            significant = numpy.abs(pulls) > n_sigma
+            flagged[name] = zip(bins[significant], pulls[significant])
+            if flagged[name]:
+                LOGGER.warning('%s differs significantly in %d bins', name, len(flagged[name]))
+            lines.append('{0:<20} {1:>3d} bins flagged, max |pull| {2:.2f}'.format(name, len(flagged[name]), numpy.abs(pulls).max()))
+            lines.extend('    bin {0:>3d} pull {1:>+7.2f}'.format(i, pull) for i, pull in flagged[name])
+            h_old.legendstyle = 'le'
+            h_new.legendstyle = 'le'
+            h_stack = self.make_stack(h_old, h_new)
+            self.draw(h_stack, name, option='e nostack', **options)
+        with open(os.path.join(self.dest, 'sampled_validation.txt'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return flagged
+
+    def get_histograms(self, sample, title, plots, chunk_size=100000, fraction=None, seed=None):
+        """Fill the normalized histograms of all plots in a single pass over a sample.
+
+        The histograms follow TTree.Draw: entries where an index is out of
+        range are skipped, and a plot whose expression or selection uses
+        array branches without an index fills one value per element, up to
+        the smallest size of those arrays, with the selection applied per
+        element. Given a fraction, only a random subset of the clusters of
+        the tree are read, as chosen by sample_clusters().
+        """
+        hists = {}
+        nodes = {}
+        selections = {}
+        plot_outputs = {}
+        for name, options in plots.iteritems():
+            n_bins, low, high = options['binning']
+            hists[name] = Hist(int(n_bins), float(low), float(high), name='h_{0}'.format(uuid.uuid4().hex), title=title)
+            hists[name].Sumw2()
+            nodes[name] = numpy_formula.parse(options['varexp'])
+            if options.get('selection'):
+                selections[name] = numpy_formula.parse(options['selection'])
+            plot_outputs[name] = [nodes[name]] + ([selections[name]] if name in selections else [])
+        plot_unindexed = dict(
+            (name, set().union(*[numpy_formula.unindexed_leaves(node) for node in plot_output]))
+            for name, plot_output in plot_outputs.iteritems()
+        )
+        outputs = nodes.values() + selections.values()
+        branches = sorted(set().union(*[numpy_formula.leaves(node) for node in outputs]))
+        LOGGER.debug('Filling %d histograms from %s reading %d branches', len(hists), sample, len(branches))
+        reader = TreeReader(sample, 'tree')
+        plan = numpy_formula.EvaluationPlan(outputs, reader.size_branches(branches))
+        if fraction is None:
+            ranges = numpy_formula.chunk_ranges(reader.n_entries, chunk_size)
+        else:
+            ranges = [
+                chunk
+                for cluster_start, cluster_stop in sample_clusters(reader.tree, fraction, seed)
+                for chunk in numpy_formula.chunk_ranges(cluster_stop, chunk_size, cluster_start)
+            ]
+        for start, stop in ranges:
+            columns = reader.read(branches, start, stop)
+            results = dict(zip(outputs, plan.evaluate(columns)))
+            for name, node in nodes.iteritems():
+                looped = [leaf for leaf in plot_unindexed[name] if isinstance(columns[leaf], numpy_formula.JaggedColumn)]
+                if looped:
+                    # Evaluate the plot once per element of the arrays used without an index.
+                    looped_nodes, expanded, _ = numpy_formula.expand_instances(plot_outputs[name], columns)
+                    plot_results = dict(zip(plot_outputs[name], numpy_formula.EvaluationPlan(looped_nodes).evaluate(expanded)))
+                else:
+                    plot_results = results
+                values, mask = plot_results[node]
+                if name in selections:
+                    passed, passed_valid = plot_results[selections[name]]
+                    passed = passed.astype(bool)
+                    if passed_valid is not None:
+                        passed &= passed_valid
+                    mask = passed if mask is None else mask & passed
+                if mask is not None:
+                    values = values[mask]
+                hists[name].fill_array(values)
+        reader.close()
+        for h in hists.itervalues():
+            if h.Integral() > 0:
+                h.Scale(1. / h.Integral())
+        return hists
+
+    def compare_events(self, sample_old, sample_new, plots, tolerance=1e-6, chunk_size=100000):
+        """Compare the variables of the same events in both samples.
+
+        The samples are joined on (run, lumi, event) with their EventIndex.
+        The variables of all plots are evaluated with numpy_formula in a
+        single pass over each sample. For each variable, the number of
+        matched events whose values differ by more than the tolerance,
+        relative to the old value, and the mean, RMS, and maximum absolute
+        difference are reported and written to event_matching.txt in the
+        destination directory.
+
+        Parameters
+        ----------
+        sample_old, sample_new : path
+            The paths or XRootD urls of the old and new samples.
+        plots : dict
+            The plot options by name, as passed to __call__.
+        tolerance : float, optional
+            The relative difference below which values are equal.
+            The default is 1e-6.
+        chunk_size : int, optional
+            The number of entries read at a time. The default is 100000.
+
+        Returns
+        -------
+        report : dict
+            The statistics of the differences of each plot by name.
+        """
+        index_directory = os.path.join(self.dest, 'indices')
+        index_old = EventIndex.load(sample_old, index_directory)
+        index_new = EventIndex.load(sample_new, index_directory)
+        entries_old, entries_new = index_old.match(index_new)
+        LOGGER.info('Matched %d events, %d only in %s and %d only in %s', len(entries_old),
+                    len(index_old) - len(entries_old), self.version_old,
+                    len(index_new) - len(entries_new), self.version_new)
+        names = sorted(plots)
+        nodes = [numpy_formula.parse(plots[name]['varexp']) for name in names]
+        values_old = self._evaluate_entries(sample_old, nodes, entries_old, chunk_size)
+        values_new = self._evaluate_entries(sample_new, nodes, entries_new, chunk_size)
+        report = {}
+        lines = ['{0} vs {1}: {2} matched events'.format(self.version_old, self.version_new, len(entries_old))]
+        lines.append('{0:<20} {1:>10} {2:>12} {3:>12} {4:>12}'.format('plot', 'n_differ', 'mean_diff', 'rms_diff', 'max_diff'))
+        for name, old, new in zip(names, values_old, values_new):
+            diff = new - old
+            differ = numpy.abs(diff) > tolerance * numpy.maximum(numpy.abs(old), 1)
+            stats = {
+                'n_matched': len(diff),
+                'n_differ': int(numpy.count_nonzero(differ)),
+                'mean_diff': float(diff.mean()) if len(diff) else 0.0,
+                'rms_diff': float(numpy.sqrt(numpy.mean(diff ** 2))) if len(diff) else 0.0,
+                'max_diff': float(numpy.abs(diff).max()) if len(diff) else 0.0,
+            }
+            report[name] = stats
+            lines.append('{0:<20} {n_differ:>10d} {mean_diff:>12.4g} {rms_diff:>12.4g} {max_diff:>12.4g}'.format(name, **stats))
+        with open(os.path.join(self.dest, 'event_matching.txt'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        for line in lines:
+            LOGGER.info(line)
+        return report
+
+    def _evaluate_entries(self, sample, nodes, entries, chunk_size):
+        """Evaluate expressions for the given entries of a sample, in the order given."""
+        branches = sorted(set().union(*[numpy_formula.leaves(node) for node in nodes]))
+        reader = TreeReader(sample, 'tree')
+        plan = numpy_formula.EvaluationPlan(nodes, reader.size_branches(branches))
+        order = numpy.argsort(entries, kind='mergesort')
+        sorted_entries = entries[order]
+        values = [numpy.empty(len(entries), dtype=numpy.float64) for _ in nodes]
+        for start, stop in numpy_formula.chunk_ranges(reader.n_entries, chunk_size):
+            first, last = numpy.searchsorted(sorted_entries, [start, stop])
+            if first == last:
+                continue
+            columns = reader.read(branches, start, stop)
+            mask = numpy.zeros(stop - start, dtype=bool)
+            mask[sorted_entries[first:last] - start] = True
+            columns = numpy_formula.filter_columns(columns, mask)
+            for array, result in zip(values, plan.evaluate_instance(columns)):
+                array[order[first:last]] = result
+        reader.close()
+        return values
+
+    def auto_validate(self, samples, n_bins=50, max_entries=200000, group_size=100, processes=None, n_report=100):
+        """Compare every numeric branch shared by the old and new samples.
+
+        For each pair of samples, the branches both versions share are
+        histogrammed in quantile bins of the old sample, and their
+        Kolmogorov-Smirnov distance and chi2 per degree of freedom are
+        computed for all branches at once. The pairs of samples are
+        processed in parallel. The variables ranked by decreasing KS
+        distance are written to auto_validation.txt in the destination
+        directory.
+
+        Parameters
+        ----------
+        samples : dict
+            The (old, new) pairs of sample paths or XRootD urls by label.
+        n_bins : int, optional
+            The maximum number of quantile bins. The default is 50.
+        max_entries : int, optional
+            The number of leading entries of each sample compared.
+            The default is 200000.
+        group_size : int, optional
+            The number of branches read at a time. The default is 100.
+        processes : int, optional
+            The number of worker processes. The default is the number
+            of CPUs, up to the number of sample pairs.
+        n_report : int, optional
+            The number of most-changed variables reported. The default is
+            100. All variables are returned.
+
+        Returns
+        -------
+        rows : list of tuples
+            The (label, branch, ks_distance, ks_p_value, chi2_ndf) of
+            every variable in ranked order.
+        """
+        tasks = [(label, old, new, n_bins, max_entries, group_size) for label, (old, new) in sorted(samples.iteritems())]
+        pool = multiprocessing.Pool(processes or min(len(tasks), multiprocessing.cpu_count()))
+        try:
+            rows = [row for result in pool.map(_auto_validate_task, tasks) for row in result]
+        finally:
+            pool.close()
+            pool.join()
+        rows.sort(key=lambda row: (-row[2], -row[4]))
+        lines = ['{0} vs {1}: {2} variables, most changed first'.format(self.version_old, self.version_new, len(rows))]
+        lines.append('{0:<16} {1:<40} {2:>10} {3:>10} {4:>10}'.format('sample', 'branch', 'ks', 'ks_p', 'chi2_ndf'))
+        for row in rows[:n_report]:
+            lines.append('{0:<16} {1:<40} {2:>10.4f} {3:>10.3g} {4:>10.3g}'.format(*row))
+        with open(os.path.join(self.dest, 'auto_validation.txt'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return rows
+
     def make_stack(self, h_old, h_new):
         h_old.SetLineColor('red')
         h_new.SetLineColor('blue')
@@ -50,9 +575,9 @@ class HeppyValidationPlot(object):
         h_stack.Add(h_new)
         return h_stack
 
-    def draw(self, h_stack, name, x_title, *args, **kwargs):
+    def draw(self, h_stack, name, x_title, option='hist nostack', *args, **kwargs):
         canvas = Canvas()
-        h_stack.Draw('hist nostack')
+        h_stack.Draw(option)
         h_stack.xaxis.SetTitle(x_title)
         h_stack.SetMaximum(h_stack.max() * 1.15)
         legend = Legend(h_stack.hists)
@@ -158,6 +683,26 @@ if __name__ == '__main__':
     }
 
     plotter = HeppyValidationPlot('V23', 'V24')
-    for plot, options in PLOTS.iteritems():
-        plotter(SAMPLE_OLD, SAMPLE_NEW, plot, options)
+    plotter.validate(SAMPLE_OLD, SAMPLE_NEW, PLOTS)
+    # A quick look at a tenth of each sample would instead be
+    # plotter.validate_sampled(SAMPLE_OLD, SAMPLE_NEW, PLOTS, fraction=0.1, seed=1)
+    plotter.compare_events(SAMPLE_OLD, SAMPLE_NEW, PLOTS)
+
+    # Check every shared branch of all the samples.
+    SAMPLES = {
+        'MET2016B': (
+            XRD_REDIRECTOR + '/store/user/cvernier/VHBBHeppyV23/MET/VHBB_HEPPY_V23_MET__Run2016B-PromptReco-v2/160717_203439/0000/tree_10.root',
+            XRD_REDIRECTOR + '/store/user/arizzi/VHBBHeppyV24/MET/VHBB_HEPPY_V24_MET__Run2016B-PromptReco-v2/160910_205551/0000/tree_10.root',
+        ),
+        'QCDHT200': (
+            XRD_REDIRECTOR + '/store/user/perrozzi/VHBBHeppyV23/QCD_HT200to300_TuneCUETP8M1_13TeV-madgraphMLM-pythia8/VHBB_HEPPY_V23_QCD_HT200to300_TuneCUETP8M1_13TeV-madgraphMLM-Py8__spr16MAv2-puspr16_80r2as_2016_MAv2_v0_ext1-v1/160717_082458/0000/tree_1.root',
+            XRD_REDIRECTOR + '/store/user/arizzi/VHBBHeppyV24/QCD_HT200to300_TuneCUETP8M1_13TeV-madgraphMLM-pythia8/VHBB_HEPPY_V24_QCD_HT200to300_TuneCUETP8M1_13TeV-madgraphMLM-Py8__spr16MAv2-puspr16_80r2as_2016_MAv2_v0_ext1-v1/160909_075702/0000/tree_1.root',
+        ),
+        'ZJetsHT200': (
+            XRD_REDIRECTOR + '/store/user/perrozzi/VHBBHeppyV23/ZJetsToNuNu_HT-200To400_13TeV-madgraph/VHBB_HEPPY_V23_ZJetsToNuNu_HT-200To400_13TeV-madgraph__spr16MAv2-puspr16_80r2as_2016_MAv2_v0_ext1-v1/160718_081847/0000/tree_1.root',
+            XRD_REDIRECTOR + '/store/user/arizzi/VHBBHeppyV24/ZJetsToNuNu_HT-200To400_13TeV-madgraph/VHBB_HEPPY_V24_ZJetsToNuNu_HT-200To400_13TeV-madgraph__spr16MAv2-puspr16_80r2as_2016_MAv2_v0_ext1-v1/160909_073933/0000/tree_1.root',
+        ),
+        'TT': (SAMPLE_OLD, SAMPLE_NEW),
+    }
+    plotter.auto_validate(SAMPLES)
 
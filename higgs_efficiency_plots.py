@@ -1,56 +1,183 @@
-import functools
 import os
 import sys
 
 import CMS_lumi
 import ROOT
+import numpy
 import tdrstyle
 
+import numpy_formula
+from numpy_formula import TreeReader
+from kinematics import delta_r, gather
+
 # You'll need to download the CMS_lumi and tdrstyle modules provided
 # by the Publications Committee here https://ghm.web.cern.ch/ghm/plots/
 
 
-ROOT.gROOT.ProcessLine("""
-#include "TMath.h"
-#include "TVector2.h"
+# The Higgs candidates as (name, title, eta branch, phi branch).
+CANDIDATES = [
+    ('csv', 'Highest CSV', 'HCSV_eta', 'HCSV_phi'),
+    ('dijet', 'Highest Dijet', 'H_eta', 'H_phi'),
+]
 
-bool isdRMatch(float threshold, float eta1, float phi1, float eta2, float phi2) {
-  float dEta = eta1 - eta2;
-  double dPhi = TVector2::Phi_mpi_pi(phi1 - phi2);
-  if (TMath::Sqrt(dEta*dEta + dPhi*dPhi) < threshold) {
-    return true;
-  } else {
-    return false;
-  }
-}
-""")
+# The branches read for the generator level selection and dR matching.
+GEN_BRANCHES = ['GenBQuarkFromH_pt', 'GenBQuarkFromH_eta', 'GenHiggsBoson_eta', 'GenHiggsBoson_phi', 'V_pt']
 
 
-def main():
-    ROOT.gROOT.SetBatch(True)
-    f = ROOT.TFile.Open(sys.argv[1])
-    t = f.Get('tree')
-    eff_csv = ROOT.TEfficiency('h_csv', 'Highest CSV Higgs;p_{T}(V) (GeV);Efficiency', 20, 0, 500)
-    eff_dijet = ROOT.TEfficiency('h_dijet', 'Highest Dijet Higgs;p_{T}(V) (GeV);Efficiency', 20, 0, 500)
-    # Creating references to instance methods avoids spending time on attribute lookup in the for loop.
-    fill_csv = eff_csv.Fill
-    fill_dijet = eff_dijet.Fill
-    # Preload threshold value for simplified function call.
-    isdRMatch = functools.partial(ROOT.isdRMatch, 0.5)
-    for i, e in enumerate(t):
-        if i % 10000 == 0:
-            print 'Processing event {!s}'.format(i)
+def _histogram(values, edges):
+    """Count values in bins of [low, high) like TH1.Fill, ignoring under and overflows."""
+    bins = numpy.searchsorted(edges, values, side='right') - 1
+    bins = bins[(bins >= 0) & (bins < len(edges) - 1)]
+    return numpy.bincount(bins, minlength=len(edges) - 1)
+
+
+def _element(column, i):
+    """Return the i-th element of a variable size column for every entry,
+    along with a mask of which entries have one. Scalar columns are
+    returned as they are.
+    """
+    if isinstance(column, numpy_formula.JaggedColumn):
+        return gather(column, numpy.full(len(column), i, dtype=numpy.int64))
+    return column, numpy.ones(len(column), dtype=bool)
+
+
+def scan_matches(path, thresholds, candidates=CANDIDATES, bins=(20, 0, 500), chunk_size=100000):
+    """Count the events passing the generator level selection and those
+    whose Higgs candidates are dR matched to the generator Higgs boson,
+    in bins of p_T(V), for every combination of dR threshold and Higgs
+    candidate in a single pass over chunks of entries.
+
+    Events are selected if both GenBQuarkFromH have p_T > 20 GeV and
+    |eta| < 2.5, and a candidate matches if it is within dR < threshold
+    of the first GenHiggsBoson. Events without two b quarks or a Higgs
+    boson at generator level are skipped.
+
+    Parameters
+    ----------
+    path : path
+        The path or XRootD url to a Heppy ntuple.
+    thresholds : list of floats
+        The dR thresholds.
+    candidates : list of tuples, optional
+        The Higgs candidates as (name, title, eta branch, phi branch).
+        The default is the highest CSV and highest dijet candidates.
+    bins : tuple, optional
+        The number of bins, lower, and upper edge of the p_T(V) binning.
+    chunk_size : int, optional
+        The number of entries read at a time. The default is 100000.
+
+    Returns
+    -------
+    edges : numpy.array
+        The bin edges.
+    total : numpy.array
+        The number of selected events per bin.
+    passed : numpy.array
+        The number of matched events per candidate, threshold, and bin.
+    """
+    n_bins, low, high = bins
+    edges = numpy.linspace(low, high, n_bins + 1)
+    thresholds = numpy.asarray(thresholds, dtype=numpy.float64)
+    total = numpy.zeros(n_bins, dtype=numpy.int64)
+    passed = numpy.zeros((len(candidates), len(thresholds), n_bins), dtype=numpy.int64)
+    branches = sorted(set(GEN_BRANCHES) | set(x for _, _, eta, phi in candidates for x in (eta, phi)))
+    reader = TreeReader(path, 'tree')
+    for start, stop in numpy_formula.chunk_ranges(reader.n_entries, chunk_size):
+        print 'Processing event {!s}'.format(start)
+        columns = reader.read(branches, start, stop)
+        (pt0, valid0), (pt1, valid1) = [_element(columns['GenBQuarkFromH_pt'], i) for i in (0, 1)]
+        eta0, eta1 = [_element(columns['GenBQuarkFromH_eta'], i)[0] for i in (0, 1)]
+        higgs_eta, valid_higgs = _element(columns['GenHiggsBoson_eta'], 0)
+        higgs_phi, _ = _element(columns['GenHiggsBoson_phi'], 0)
         # Generator level selection cuts.
-        min_GenBQuarkFromH_pt = min(e.GenBQuarkFromH_pt[0], e.GenBQuarkFromH_pt[1])
-        max_abs_GenBQuarkFromH_eta = max(abs(e.GenBQuarkFromH_eta[0]), abs(e.GenBQuarkFromH_eta[1]))
-        if min_GenBQuarkFromH_pt < 20 or max_abs_GenBQuarkFromH_eta > 2.5:
-            continue
-        # Higgs candidate dR matching. Note that GenHiggsBoson is a PyFloatBuffer,
-        # so it must be accessed by index as opposed to the Higgs candidate.
-        match_csv = isdRMatch(e.GenHiggsBoson_eta[0], e.GenHiggsBoson_phi[0], e.HCSV_eta, e.HCSV_phi)
-        fill_csv(match_csv, e.V_pt)
-        match_dijet = isdRMatch(e.GenHiggsBoson_eta[0], e.GenHiggsBoson_phi[0], e.H_eta, e.H_phi)
-        fill_dijet(match_dijet, e.V_pt)
+        selected = (
+            valid0 & valid1 & valid_higgs &
+            (numpy.minimum(pt0, pt1) >= 20) &
+            (numpy.maximum(numpy.abs(eta0), numpy.abs(eta1)) <= 2.5)
+        )
+        v_pt = columns['V_pt'][selected]
+        total += _histogram(v_pt, edges)
+        # Count every threshold at once, with the threshold as the major
+        # index of the (threshold, bin) cells of a single bincount.
+        v_pt_bins = numpy.searchsorted(edges, v_pt, side='right') - 1
+        in_range = (v_pt_bins >= 0) & (v_pt_bins < n_bins)
+        cells = numpy.arange(len(thresholds))[:, numpy.newaxis] * n_bins + v_pt_bins[in_range]
+        for i, (_, _, eta, phi) in enumerate(candidates):
+            dr = delta_r(higgs_eta[selected], higgs_phi[selected], columns[eta][selected], columns[phi][selected])
+            match = dr[in_range] < thresholds[:, numpy.newaxis]
+            passed[i] += numpy.bincount(cells[match], minlength=len(thresholds) * n_bins).reshape(len(thresholds), n_bins)
+    reader.close()
+    return edges, total, passed
+
+
+def count_matches(path, threshold=0.5, bins=(20, 0, 500), candidates=CANDIDATES, chunk_size=100000):
+    """Count the selected and matched events for a single dR threshold.
+
+    Returns
+    -------
+    edges : numpy.array
+        The bin edges.
+    total : numpy.array
+        The number of selected events per bin.
+    passed : dict
+        The number of matched events per bin by candidate name.
+    """
+    edges, total, passed = scan_matches(path, [threshold], candidates, bins, chunk_size)
+    return edges, total, dict((candidate[0], counts[0]) for candidate, counts in zip(candidates, passed))
+
+
+def clopper_pearson(passed, total, level=0.682689492137086):
+    """Return the efficiencies and their Clopper-Pearson confidence
+    intervals for arrays of passed and total counts, as TEfficiency does
+    by default. Bins without events have an efficiency of zero and an
+    interval of [0, 1].
+
+    Returns
+    -------
+    efficiency, lower, upper : numpy.array
+        The efficiencies and the bounds of their confidence intervals.
+    """
+    passed = numpy.asarray(passed, dtype=numpy.float64)
+    total = numpy.broadcast_to(numpy.asarray(total, dtype=numpy.float64), passed.shape)
+    efficiency = numpy.where(total > 0, passed / numpy.maximum(total, 1), 0.)
+    bound = numpy.vectorize(ROOT.TEfficiency.ClopperPearson, otypes=[numpy.float64])
+    return efficiency, bound(total, passed, level, False), bound(total, passed, level, True)
+
+
+def efficiency_graph(name, title, edges, passed, total):
+    """Return a TGraphAsymmErrors of the efficiencies and their Clopper-Pearson
+    intervals, with a point per bin with events, like TEfficiency.Draw paints.
+    """
+    efficiency, lower, upper = clopper_pearson(passed, total)
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    half_widths = 0.5 * numpy.diff(edges)
+    filled = numpy.flatnonzero(total > 0)
+    graph = ROOT.TGraphAsymmErrors(len(filled))
+    graph.SetName(name)
+    graph.SetTitle(title)
+    for point, i in enumerate(filled):
+        graph.SetPoint(point, centers[i], efficiency[i])
+        graph.SetPointError(point, half_widths[i], half_widths[i], efficiency[i] - lower[i], upper[i] - efficiency[i])
+    return graph
+
+
+def efficiency_table(thresholds, candidates, total, passed):
+    """Format the efficiency integrated over p_T(V) of every candidate and
+    threshold as a table, with a row per candidate and a column per threshold.
+    """
+    efficiency, lower, upper = clopper_pearson(passed.sum(axis=2), total.sum())
+    lines = ['{0:<16}'.format('dR <') + ''.join('{0:>22g}'.format(x) for x in thresholds)]
+    for i, candidate in enumerate(candidates):
+        cells = [
+            '{0:.3f} +{1:.3f} -{2:.3f}'.format(efficiency[i, j], upper[i, j] - efficiency[i, j], efficiency[i, j] - lower[i, j])
+            for j in xrange(len(thresholds))
+        ]
+        lines.append('{0:<16}'.format(candidate[1]) + ''.join('{0:>22}'.format(cell) for cell in cells))
+    return '\n'.join(lines)
+
+
+def draw_efficiencies(graphs, titles, edges, outfile):
+    """Draw efficiency curves in the CMS style and save them as png and pdf."""
     # Format plotting style.
     tdrstyle.setTDRStyle()
     CMS_lumi.extraText = 'Simulation'
@@ -66,26 +193,25 @@ def main():
     c.SetBottomMargin(0.12)
     c.SetTickx(0)
     c.SetTicky(0)
-    eff_csv.SetLineColor(ROOT.kRed)
-    eff_csv.SetFillColor(ROOT.kRed)
-    eff_csv.Draw()
-    eff_dijet.SetLineColor(ROOT.kBlue)
-    eff_dijet.SetFillColor(ROOT.kBlue)
-    eff_dijet.Draw('same')
+    colors = [ROOT.kRed, ROOT.kBlue, ROOT.kGreen + 2, ROOT.kMagenta, ROOT.kOrange + 7, ROOT.kCyan + 2]
+    for i, graph in enumerate(graphs):
+        graph.SetLineColor(colors[i % len(colors)])
+        graph.SetFillColor(colors[i % len(colors)])
+        graph.Draw('AP' if i == 0 else 'P same')
+    graphs[0].GetXaxis().SetLimits(edges[0], edges[-1])
+    graphs[0].SetMinimum(0)
+    graphs[0].SetMaximum(1.3)
     ROOT.gPad.Update()
-    graph_csv = eff_csv.GetPaintedGraph()
-    graph_dijet = eff_dijet.GetPaintedGraph()
-    graph_csv.SetMaximum(1.3)
-    x_axis = graph_csv.GetXaxis()
+    x_axis = graphs[0].GetXaxis()
     line_unity = ROOT.TLine(x_axis.GetXmin(), 1, x_axis.GetXmax(), 1)
     line_unity.SetLineStyle(2)
     line_unity.Draw('same')
-    y_axis = graph_csv.GetYaxis()
+    y_axis = graphs[0].GetYaxis()
     y_axis.SetTitleOffset(1)
-    legend = ROOT.TLegend(0.75, 0.18, 0.95, 0.35)
+    legend = ROOT.TLegend(0.75, 0.18, 0.95, 0.18 + 0.085 * len(graphs))
     legend.SetFillStyle(0)
-    legend.AddEntry(graph_csv, 'Highest CSV', 'le')
-    legend.AddEntry(graph_dijet, 'Highest Dijet', 'le')
+    for graph, title in zip(graphs, titles):
+        legend.AddEntry(graph, title, 'le')
     legend.Draw('same')
     latex = ROOT.TLatex()
     latex.SetNDC()
@@ -101,12 +227,34 @@ def main():
     c.RedrawAxis()
     frame = c.GetFrame()
     frame.Draw()
-    c.SaveAs('higgs_efficiency_WlnH.png')
-    c.SaveAs('higgs_efficiency_WlnH.pdf')
-    f.Close()
+    c.SaveAs(outfile + '.png')
+    c.SaveAs(outfile + '.pdf')
+
+
+def main():
+    """Plot the Higgs candidate matching efficiencies of an ntuple.
+
+    Usage: higgs_efficiency_plots.py NTUPLE [THRESHOLD ...]
+
+    The default dR threshold is 0.5. Given several thresholds, all of
+    them are computed in a single pass, a plot is drawn per threshold,
+    and the table of integrated efficiencies is printed.
+    """
+    ROOT.gROOT.SetBatch(True)
+    thresholds = [float(x) for x in sys.argv[2:]] or [0.5]
+    edges, total, passed = scan_matches(sys.argv[1], thresholds)
+    titles = [title for _, title, _, _ in CANDIDATES]
+    for j, threshold in enumerate(thresholds):
+        graphs = [
+            efficiency_graph('h_{0}'.format(name), '{0} Higgs;p_{{T}}(V) (GeV);Efficiency'.format(title), edges, passed[i, j], total)
+            for i, (name, title, _, _) in enumerate(CANDIDATES)
+        ]
+        outfile = 'higgs_efficiency_WlnH' if len(thresholds) == 1 else 'higgs_efficiency_WlnH_dR{0:g}'.format(threshold)
+        draw_efficiencies(graphs, titles, edges, outfile)
+    if len(thresholds) > 1:
+        print efficiency_table(thresholds, CANDIDATES, total, passed)
 
 if __name__ == '__main__':
 
     status = main()
     sys.exit(status)
-
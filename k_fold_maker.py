@@ -1,17 +1,69 @@
+import collections
+import json
+import os
+
 import ROOT
 import numpy
+import root_numpy
 
-# More ideas:
-# Return the 'k' folds as numpy arrays for Theano?
-# Save the 'k' folds as .mat or .npy binaries for reproducibility and portability?
-# If there are an imbalance of classes, stratify the sampling for the folds?
+from npy_appender import NpyAppender
 
 def set_dtype(tree, branch_name):
     pass
 
 
-def create_k_folds(input_root_file_name, input_tree_name=None, k_folds=None):
+def splitmix64(x):
+    """Apply the splitmix64 finalizer, a fast and well mixing 64-bit hash, elementwise."""
+    x = numpy.asarray(x, dtype=numpy.uint64)
+    with numpy.errstate(over='ignore'):
+        x = x + numpy.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return x ^ (x >> numpy.uint64(31))
+
+
+def event_hash(run, lumi, event, seed=0):
+    """Return a stable 64-bit hash of each (run, lumi, event), which doesn't
+    depend on the file, the entry order, or the other events.
+    """
+    h = splitmix64(numpy.uint64(seed) ^ numpy.asarray(run).astype(numpy.uint64))
+    h = splitmix64(h ^ numpy.asarray(lumi).astype(numpy.uint64))
+    return splitmix64(h ^ numpy.asarray(event).astype(numpy.uint64))
+
+
+def assign_folds(run, lumi, event, k_folds, seed=0):
+    """Assign events to k folds from the hash of their (run, lumi, event).
+
+    The fold of an event is its hash modulo k, so each event is assigned
+    on its own, without reference to any other event, and the same event
+    lands in the same fold in any file, sample, order, or reprocessing.
+    The folds of a large sample are balanced, overall and for every class
+    of events, to within statistical fluctuations.
+
+    Returns
+    -------
+    folds : numpy.array
+        The fold number of each event, from 0 to k_folds - 1.
+    """
+    hashes = event_hash(run, lumi, event, seed)
+    return (hashes % numpy.uint64(k_folds)).astype(numpy.int64)
+
+
+def create_k_folds(input_root_file_name, input_tree_name=None, k_folds=None, index_only=False,
+                   fold_by='range', event_branches=('run', 'lumi', 'evt'), seed=0, chunk_size=100000):
     """Inspect a .root ntuple and resample a TTree into k-folds for cross-validation.
+
+    The input tree is read in a single pass, with each entry routed to the
+    test tree of its fold and to the training trees of all other folds.
+    With index_only, no event data is copied. Instead, the training and
+    test entries of every fold are written as TEntryLists to a single file,
+    k_folds/CVFolds_<k_folds>.root, for use with TTree.SetEntryList.
+
+    By default, the folds are contiguous ranges of entries. With fold_by
+    set to 'hash', the folds are assigned by assign_folds() from the
+    event_branches, so the folds are reproducible across files and don't
+    depend on the entry order. The event_branches are then read chunk_size
+    entries at a time.
     """
     input_root_file = ROOT.TFile(input_root_file_name)
     # Check function arguments.
@@ -23,6 +75,9 @@ def create_k_folds(input_root_file_name, input_tree_name=None, k_folds=None):
     elif k_folds is None:
         print "\nUnspecified number of folds."
         return
+    elif fold_by not in ('range', 'hash'):
+        print "\nUnknown fold assignment %r." % fold_by
+        return
     else:
         input_tree = input_root_file.Get(input_tree_name)
         input_tree_n_entries = input_tree.GetEntriesFast()
@@ -30,41 +85,41 @@ def create_k_folds(input_root_file_name, input_tree_name=None, k_folds=None):
     output_directory = 'k_folds/'
     if (ROOT.gSystem.AccessPathName(output_directory)):
         ROOT.gSystem.mkdir(output_directory)
-    # Determine the number of entries per fold, assuming the total number of entries is exactly divisible into k folds.
-    # Create a list holding the entry indices specifying the endpoints for each fold.
-    n_entries_per_fold = int(input_tree_n_entries / k_folds)
-    range_list = range(0, n_entries_per_fold * (k_folds + 1), n_entries_per_fold)
-    # If a remainder exists, we modify accordingly.
-    n_entries_remainder = int(input_tree_n_entries % k_folds)
-    if n_entries_remainder != 0:
-        for extra in xrange(len(range_list)):
-            if extra < n_entries_remainder:
-                range_list[extra] += extra
-            else:
-                range_list[extra] += n_entries_remainder
-    # Loop over each fold.
+    folds = _fold_numbers(input_tree, input_tree_n_entries, k_folds, fold_by, event_branches, seed, chunk_size)
+    if index_only:
+        _write_k_fold_entry_lists(input_root_file_name, input_tree, folds, k_folds, output_directory)
+        input_root_file.Close()
+        return "Successfully wrote entry lists for %s-fold cross-validation." % k_folds
+    # Create the output .root file of each fold, holding empty copies of the tree
+    # for the training and "testing" samples. The copies share the branch addresses
+    # of the input tree, so filling them copies the entry most recently read.
+    output_root_files = []
+    output_train_trees = []
+    output_test_trees = []
     for k in xrange(k_folds):
-        # Create output .root file for the current fold.
         output_root_file_name = output_directory + 'CVFold_%s_of_%s.root' % (k+1, k_folds)
-        output_root_file = TFile(output_root_file_name, 'RECREATE')
-        # Copy an empty tree to hold the training sample.
+        output_root_file = ROOT.TFile(output_root_file_name, 'RECREATE')
+        # The trees are created in the current directory, which is the new file.
         output_train_tree = input_tree.CloneTree(0)
         output_train_tree.SetName('%s_CV_Train' % input_tree.GetName())
-        # Copy an empty tree to hold the "testing" sample.
         output_test_tree = input_tree.CloneTree(0)
         output_test_tree.SetName('%s_CV_Test' % input_tree.GetName())
-        # Loop over the input tree entries, storing it for testing if it falls within the range
-        # and training otherwise. I find this faster than conditionals within the loop.
-        for entry in xrange(range_list[k]):
-            input_tree.GetEntry(entry, 1) # The second argument 1 means get all branches.
-            output_train_tree.Fill()
-        for entry in xrange(range_list[k], range_list[k+1]):
-            input_tree.GetEntry(entry, 1)
-            output_test_tree.Fill()
-        for entry in xrange(range_list[k+1], input_tree_n_entries):
-            input_tree.GetEntry(entry, 1)
-            output_train_tree.Fill()
-        # Write the output trees and save the output file.
+        output_root_files.append(output_root_file)
+        output_train_trees.append(output_train_tree)
+        output_test_trees.append(output_test_tree)
+    # Read each entry once, storing it for testing in its fold and for
+    # training in every other fold.
+    fold_fills = [
+        [output_test_trees[fold].Fill] + [tree.Fill for k, tree in enumerate(output_train_trees) if k != fold]
+        for fold in xrange(k_folds)
+    ]
+    for entry, fold in enumerate(folds.tolist()):
+        input_tree.GetEntry(entry, 1) # The second argument 1 means get all branches.
+        for fill in fold_fills[fold]:
+            fill()
+    # Write the output trees and save the output files.
+    for output_root_file, output_train_tree, output_test_tree in zip(output_root_files, output_train_trees, output_test_trees):
+        output_root_file.cd()
         output_train_tree.Write()
         output_test_tree.Write()
         output_root_file.Close()
@@ -73,3 +128,158 @@ def create_k_folds(input_root_file_name, input_tree_name=None, k_folds=None):
     # Future Sean cringes at lack of logging.
     return "Successfully split entries for %s-fold cross-validation." % k_folds
 
+
+def _fold_numbers(input_tree, input_tree_n_entries, k_folds, fold_by, event_branches, seed, chunk_size):
+    """Return the fold number of every entry of the input tree."""
+    if fold_by == 'hash':
+        folds = numpy.empty(input_tree_n_entries, dtype=numpy.int64)
+        # Only one chunk of the event branches is held in memory at a time.
+        for start in xrange(0, input_tree_n_entries, chunk_size):
+            stop = min(start + chunk_size, input_tree_n_entries)
+            columns = root_numpy.tree2array(input_tree, branches=list(event_branches), start=start, stop=stop)
+            folds[start:stop] = assign_folds(*[columns[x] for x in event_branches], k_folds=k_folds, seed=seed)
+        return folds
+    # Split the entries into contiguous folds, with the remainder of the
+    # division spread over the first folds, one entry each.
+    n_entries_per_fold = input_tree_n_entries // k_folds + (numpy.arange(k_folds) < input_tree_n_entries % k_folds)
+    return numpy.repeat(numpy.arange(k_folds), n_entries_per_fold)
+
+
+def _write_k_fold_entry_lists(input_root_file_name, input_tree, folds, k_folds, output_directory):
+    """Write the training and test entries of each fold as TEntryLists."""
+    output_root_file = ROOT.TFile(output_directory + 'CVFolds_%s.root' % k_folds, 'RECREATE')
+    tree_name = input_tree.GetName()
+    # Enter every entry once, into the test list of its fold. The entries
+    # are entered in increasing order, which TEntryList stores most compactly.
+    test_lists = []
+    for k in xrange(k_folds):
+        test_list = ROOT.TEntryList('%s_CV_Test_%s_of_%s' % (tree_name, k+1, k_folds), 'Test entries', tree_name, input_root_file_name)
+        test_enter = test_list.Enter
+        for entry in numpy.flatnonzero(folds == k).tolist():
+            test_enter(entry)
+        test_lists.append(test_list)
+    # The training list of a fold is the union of the test lists of the
+    # other folds, which TEntryList.Add merges block by block.
+    for k, test_list in enumerate(test_lists):
+        train_list = ROOT.TEntryList('%s_CV_Train_%s_of_%s' % (tree_name, k+1, k_folds), 'Training entries', tree_name, input_root_file_name)
+        for other in test_lists[:k] + test_lists[k+1:]:
+            train_list.Add(other)
+        output_root_file.cd()
+        train_list.Write()
+        test_list.Write()
+    output_root_file.Close()
+
+
+def export_k_folds(input_root_file_name, input_tree_name, k_folds, branches, fold_by='range',
+                   event_branches=('run', 'lumi', 'evt'), seed=0, chunk_size=100000):
+    """Export selected branches of the k folds as memory-mappable .npy arrays.
+
+    The folds are assigned as in create_k_folds. The tree is read once, in
+    chunks, and the entries of each fold's test split are appended to a
+    .npy file per branch in k_folds/CVFolds_<k_folds>_npy/part_<k>/. The
+    training split of a fold is the test split of every other fold, so no
+    entry is stored twice. The manifest.json of the directory records the
+    columns, their dtypes and shapes, the rows and files of each part, and
+    the parts making up the training and test splits of each fold. An empty
+    input tree gives a manifest without any columns or files. Use
+    load_k_fold to open a split.
+
+    Returns
+    -------
+    output_directory : path
+        The directory holding the exported folds.
+    """
+    if fold_by not in ('range', 'hash'):
+        raise ValueError('Unknown fold assignment %r' % fold_by)
+    input_root_file = ROOT.TFile(input_root_file_name)
+    input_tree = input_root_file.Get(input_tree_name)
+    n_entries = input_tree.GetEntriesFast()
+    folds = _fold_numbers(input_tree, n_entries, k_folds, fold_by, event_branches, seed, chunk_size)
+    output_directory = 'k_folds/CVFolds_%s_npy/' % k_folds
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    appenders = None
+    columns = collections.OrderedDict()
+    for start in xrange(0, n_entries, chunk_size):
+        stop = min(start + chunk_size, n_entries)
+        chunk = root_numpy.tree2array(input_tree, branches=list(branches), start=start, stop=stop)
+        if appenders is None:
+            # The branch dtypes are only known once the first chunk is read.
+            for name in branches:
+                dtype, shape = chunk.dtype[name].base, chunk.dtype[name].shape
+                if dtype == numpy.object_:
+                    raise ValueError('Cannot export the variable size branch %s' % name)
+                columns[name] = {'dtype': numpy.lib.format.dtype_to_descr(dtype), 'shape': list(shape)}
+            for k in xrange(k_folds):
+                if not os.path.isdir(output_directory + 'part_%s' % k):
+                    os.makedirs(output_directory + 'part_%s' % k)
+            appenders = [
+                dict(
+                    (name, NpyAppender(output_directory + 'part_%s/%s.npy' % (k, name), chunk.dtype[name].base, chunk.dtype[name].shape))
+                    for name in branches
+                )
+                for k in xrange(k_folds)
+            ]
+        chunk_folds = folds[start:stop]
+        for k in xrange(k_folds):
+            selected = chunk_folds == k
+            for name in branches:
+                appenders[k][name].write(chunk[name][selected])
+    input_root_file.Close()
+    for part in appenders or []:
+        for appender in part.itervalues():
+            appender.close()
+    manifest = {
+        'input': input_root_file_name,
+        'tree': input_tree_name,
+        'k_folds': k_folds,
+        'fold_by': fold_by,
+        'columns': [dict(name=name, **column) for name, column in columns.iteritems()],
+        'parts': [
+            {
+                'part': k,
+                'rows': int(numpy.count_nonzero(folds == k)),
+                'files': dict((name, 'part_%s/%s.npy' % (k, name)) for name in columns),
+            }
+            for k in xrange(k_folds)
+        ],
+        'folds': [
+            {'fold': k + 1, 'train': [x for x in xrange(k_folds) if x != k], 'test': [k]}
+            for k in xrange(k_folds)
+        ],
+    }
+    with open(output_directory + 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return output_directory
+
+
+def load_k_fold(path, fold, split, mmap_mode='r'):
+    """Open the training or test split of a fold exported by export_k_folds.
+
+    Parameters
+    ----------
+    path : path
+        The directory of the exported folds.
+    fold : int
+        The fold number, from 1 to k_folds as in the CVFold_<fold>_of_<k> files.
+    split : string
+        Either 'train' or 'test'.
+    mmap_mode : string, optional
+        The memory-map mode passed to numpy.load. The default is 'r'.
+
+    Returns
+    -------
+    parts : list of collections.OrderedDict
+        The memory-mapped arrays by branch name of each part of the split.
+        Only the pages of the arrays which are accessed are read.
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    parts = manifest['folds'][fold - 1][split]
+    return [
+        collections.OrderedDict(
+            (column['name'], numpy.load(os.path.join(path, manifest['parts'][part]['files'][column['name']]), mmap_mode=mmap_mode))
+            for column in manifest['columns']
+        )
+        for part in parts
+    ]
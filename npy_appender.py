@@ -0,0 +1,94 @@
+"""Write .npy files incrementally, one block of rows at a time.
+
+numpy.save needs the whole array up front because the array shape is
+part of the header. An NpyAppender instead reserves enough header space
+for any number of rows, streams blocks of rows to the file, and rewrites
+the header with the final shape when closed. The result is a regular
+.npy file which can be memory-mapped with numpy.load(path, mmap_mode='r').
+"""
+import os
+
+import numpy
+
+
+class NpyAppender(object):
+    """Append blocks of rows to a .npy file.
+
+    Parameters
+    ----------
+    path : path
+        The path to the output .npy file.
+    dtype : numpy.dtype
+        The data type of the array. Structured dtypes are supported.
+    row_shape : tuple of ints, optional
+        The shape of a single row, e.g. (n_features,) for a two-dimensional
+        array. The default is () for a one-dimensional array.
+    mode : string, optional
+        Either 'w' to create a new file or 'a' to append to an existing
+        file written by an NpyAppender. The default is 'w'.
+    """
+
+    MAGIC = b'\x93NUMPY\x01\x00'
+    # The largest row count the reserved header space must accommodate.
+    MAX_ROWS = 2 ** 62
+
+    def __init__(self, path, dtype, row_shape=(), mode='w'):
+        self.path = path
+        self.dtype = numpy.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.header_size = len(self._header(self.MAX_ROWS, None))
+        if mode == 'a' and os.path.isfile(path):
+            self._file = open(path, 'r+b')
+            numpy.lib.format.read_magic(self._file)
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(self._file)
+            if self._file.tell() != self.header_size or fortran_order:
+                self._file.close()
+                raise ValueError('Cannot append to {0}, whose header cannot be rewritten in place'.format(path))
+            if dtype != self.dtype or shape[1:] != self.row_shape:
+                self._file.close()
+                raise ValueError('Cannot append to {0}, which has an incompatible dtype or shape'.format(path))
+            self.n_rows = shape[0]
+            self._file.seek(0, os.SEEK_END)
+        elif mode in ('w', 'a'):
+            self.n_rows = 0
+            self._file = open(path, 'wb')
+            self._file.write(self._header(0, self.header_size))
+        else:
+            raise ValueError('Unknown mode {0!r}'.format(mode))
+
+    def _header(self, n_rows, size):
+        """Return the version 1.0 header for an array with n_rows, padded
+        with spaces to size bytes, or the minimum 64 byte aligned size.
+        """
+        header = "{{'descr': {0!r}, 'fortran_order': False, 'shape': {1!r}, }}".format(
+            numpy.lib.format.dtype_to_descr(self.dtype),
+            (n_rows,) + self.row_shape,
+        )
+        # The magic string, the two byte header length, and the newline.
+        overhead = len(self.MAGIC) + 2 + 1
+        if size is None:
+            size = -(-(overhead + len(header)) // 64) * 64
+        header = header.ljust(size - overhead) + '\n'
+        return self.MAGIC + numpy.array([len(header)], dtype='<u2').tobytes() + header.encode('latin1')
+
+    def write(self, rows):
+        """Append a block of rows to the file."""
+        rows = numpy.ascontiguousarray(rows, dtype=self.dtype)
+        if rows.shape[1:] != self.row_shape:
+            raise ValueError('Expected rows of shape {0}, found {1}'.format(self.row_shape, rows.shape[1:]))
+        self._file.write(rows.tobytes())
+        self.n_rows += len(rows)
+
+    def close(self):
+        """Rewrite the header with the final number of rows and close the file."""
+        if self._file.closed:
+            return
+        self._file.seek(0)
+        self._file.write(self._header(self.n_rows, self.header_size))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,773 @@
+"""Evaluate TTreeFormula expressions as NumPy operations on chunks of a TTree.
+
+The expressions use the same syntax as a ROOT.TTreeFormula, e.g.
+'Vtype == 4 && (V_pt > 80 || H_pt > 80)' or 'Jet_pt[hJCidx[0]]', but
+rather than evaluating them entry by entry through PyROOT, only the
+referenced branches are read in chunks with root_numpy and the whole
+chunk is evaluated at once.
+
+Variable size branches are represented as a JaggedColumn, a flat array
+of values and the offsets of each entry into it. Indexing one with a
+per-entry index, as in 'Jet_pt[hJCidx[0]]', is a single gather. Like
+TTreeFormula.EvalInstance, a variable size branch used without an index
+refers to its first element and out of range elements evaluate to zero.
+To loop over its elements instead, like TTree.Draw, the chunk is first
+expanded to one row per element with expand_instances().
+"""
+import re
+
+import ROOT
+import numpy
+import root_numpy
+
+
+class FormulaError(Exception):
+    pass
+
+
+class JaggedColumn(object):
+    """A column of variable size arrays stored as a flat array of values
+    and the offsets delimiting the values of each entry.
+
+    Parameters
+    ----------
+    content : numpy.array
+        The values of all entries concatenated together.
+    offsets : numpy.array of ints
+        An array of length n_entries + 1 such that the values of entry i
+        are content[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self, content, offsets):
+        self.content = content
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def counts(self):
+        return numpy.diff(self.offsets)
+
+    @classmethod
+    def from_array(cls, array):
+        """Create a JaggedColumn from an object array of arrays, as returned
+        by root_numpy for variable size branches, or from a two-dimensional
+        array, as returned for fixed size branches.
+        """
+        if array.ndim == 2:
+            n_entries, size = array.shape
+            offsets = numpy.arange(0, (n_entries + 1) * size, size, dtype=numpy.int64)
+            return cls(array.ravel(), offsets)
+        counts = numpy.fromiter((len(x) for x in array), dtype=numpy.int64, count=len(array))
+        offsets = numpy.zeros(len(array) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=offsets[1:])
+        if len(array):
+            content = numpy.concatenate(list(array))
+        else:
+            content = numpy.zeros(0, dtype=numpy.float64)
+        return cls(content, offsets)
+
+    def gather_positions(self, index):
+        """Return a mask of which entries have an element at a per-entry
+        index, and the positions of those elements in the content. The
+        positions can be reused by any column sharing the same offsets.
+        """
+        index = numpy.asarray(index).astype(numpy.int64)
+        valid = (index >= 0) & (index < self.counts)
+        return valid, self.offsets[:-1][valid] + index[valid]
+
+    def take(self, valid, positions):
+        """Return the values at positions found by gather_positions along
+        with the validity mask. Missing values are zero.
+        """
+        values = numpy.zeros(len(self), dtype=self.content.dtype)
+        values[valid] = self.content[positions]
+        return values, valid
+
+    def gather(self, index):
+        """Return the value at a per-entry index along with a mask of which
+        entries have an element at that index. Missing values are zero.
+        """
+        return self.take(*self.gather_positions(index))
+
+    def take_rows(self, rows):
+        """Return a JaggedColumn holding the given entries in the given
+        order, where an entry may be repeated.
+        """
+        counts = self.counts[rows]
+        offsets = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=offsets[1:])
+        positions = numpy.repeat(self.offsets[:-1][rows] - offsets[:-1], counts) + numpy.arange(offsets[-1])
+        return JaggedColumn(self.content[positions], offsets)
+
+    def slice(self, start, stop):
+        """Return a JaggedColumn holding only the entries from start to stop."""
+        offsets = self.offsets[start:stop + 1]
+        return JaggedColumn(self.content[offsets[0]:offsets[-1]], offsets - offsets[0])
+
+    def filter(self, mask):
+        """Return a JaggedColumn holding only the entries selected by a boolean mask."""
+        counts = self.counts
+        content = self.content[numpy.repeat(mask, counts)]
+        offsets = numpy.zeros(numpy.count_nonzero(mask) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts[mask], out=offsets[1:])
+        return JaggedColumn(content, offsets)
+
+
+_TOKEN_PATTERN = re.compile(r'''
+    \s*(?:
+        (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+      | (?P<name>[A-Za-z_]\w*(?:(?:::|\.)[A-Za-z_]\w*)*)
+      | (?P<operator>&&|\|\||==|!=|<=|>=|[-+*/%<>!()\[\],])
+    )''', re.VERBOSE)
+
+# The binding power of the binary operators, following C.
+_BINARY_PRECEDENCE = {
+    '||': 1,
+    '&&': 2,
+    '==': 3, '!=': 3,
+    '<': 4, '<=': 4, '>': 4, '>=': 4,
+    '+': 5, '-': 5,
+    '*': 6, '/': 6, '%': 6,
+}
+
+_UNARY_PRECEDENCE = 7
+
+_FUNCTIONS = {
+    'abs': numpy.abs,
+    'fabs': numpy.abs,
+    'TMath::Abs': numpy.abs,
+    'sqrt': numpy.sqrt,
+    'TMath::Sqrt': numpy.sqrt,
+    'exp': numpy.exp,
+    'TMath::Exp': numpy.exp,
+    'log': numpy.log,
+    'TMath::Log': numpy.log,
+    'log10': numpy.log10,
+    'TMath::Log10': numpy.log10,
+    'sin': numpy.sin,
+    'TMath::Sin': numpy.sin,
+    'cos': numpy.cos,
+    'TMath::Cos': numpy.cos,
+    'tan': numpy.tan,
+    'TMath::Tan': numpy.tan,
+    'atan2': numpy.arctan2,
+    'TMath::ATan2': numpy.arctan2,
+    'pow': numpy.power,
+    'TMath::Power': numpy.power,
+    'min': numpy.minimum,
+    'TMath::Min': numpy.minimum,
+    'max': numpy.maximum,
+    'TMath::Max': numpy.maximum,
+    'TVector2::Phi_mpi_pi': lambda phi: numpy.mod(phi + numpy.pi, 2 * numpy.pi) - numpy.pi,
+}
+
+_CONSTANTS = {
+    'TMath::Pi': numpy.pi,
+    'true': 1.0,
+    'false': 0.0,
+}
+
+
+def _tokenize(expression):
+    """Split an expression into a list of (kind, text) tokens."""
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN_PATTERN.match(expression, position)
+        if match is None or match.end() == position:
+            raise FormulaError('Unexpected character at position {0} of {1!r}'.format(position, expression))
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+    return tokens
+
+
+class _Parser(object):
+    """A precedence climbing parser producing nested tuples:
+      * ('const', value)
+      * ('leaf', name)
+      * ('index', leaf_node, index_node)
+      * ('call', function_name, argument_nodes)
+      * ('unary', operator, operand_node)
+      * ('binary', operator, left_node, right_node)
+    Being tuples, identical subexpressions compare and hash equal.
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.position = 0
+
+    def parse(self):
+        node = self._parse_expression(0)
+        if self.position != len(self.tokens):
+            self._error('Unexpected token {0!r}'.format(self.tokens[self.position][1]))
+        return node
+
+    def _error(self, message):
+        raise FormulaError('{0} while parsing {1!r}'.format(message, self.expression))
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def _expect(self, text):
+        if self._peek()[1] != text:
+            self._error('Expected {0!r}'.format(text))
+        self.position += 1
+
+    def _parse_expression(self, min_precedence):
+        left = self._parse_unary()
+        while True:
+            kind, text = self._peek()
+            precedence = _BINARY_PRECEDENCE.get(text) if kind == 'operator' else None
+            if precedence is None or precedence <= min_precedence:
+                return left
+            self.position += 1
+            right = self._parse_expression(precedence)
+            left = ('binary', text, left, right)
+
+    def _parse_unary(self):
+        kind, text = self._peek()
+        if kind == 'operator' and text in ('!', '-', '+'):
+            self.position += 1
+            operand = self._parse_expression(_UNARY_PRECEDENCE)
+            return operand if text == '+' else ('unary', text, operand)
+        return self._parse_postfix()
+
+    def _parse_postfix(self):
+        kind, text = self._peek()
+        self.position += 1
+        if kind == 'number':
+            return ('const', float(text))
+        if kind == 'operator' and text == '(':
+            node = self._parse_expression(0)
+            self._expect(')')
+            return node
+        if kind != 'name':
+            self._error('Unexpected token {0!r}'.format(text))
+        if self._peek()[1] == '(':
+            self.position += 1
+            arguments = []
+            while self._peek()[1] != ')':
+                arguments.append(self._parse_expression(0))
+                if self._peek()[1] == ',':
+                    self.position += 1
+            self._expect(')')
+            if text in _CONSTANTS and not arguments:
+                return ('const', _CONSTANTS[text])
+            if text not in _FUNCTIONS:
+                self._error('Unsupported function {0!r}'.format(text))
+            return ('call', text, tuple(arguments))
+        if text in _CONSTANTS:
+            return ('const', _CONSTANTS[text])
+        node = ('leaf', text)
+        while self._peek()[1] == '[':
+            self.position += 1
+            index = self._parse_expression(0)
+            self._expect(']')
+            if node[0] != 'leaf':
+                self._error('Only branches can be indexed')
+            node = ('index', node, index)
+        return node
+
+
+def parse(expression):
+    """Parse a TTreeFormula expression into a tree of nested tuples."""
+    return _Parser(expression).parse()
+
+
+def leaves(node):
+    """Return the set of branch names referenced by a parsed expression."""
+    if node[0] == 'leaf':
+        return {node[1]}
+    if node[0] == 'const':
+        return set()
+    if node[0] == 'call':
+        return set().union(*[leaves(argument) for argument in node[2]])
+    return set().union(*[leaves(child) for child in node[1:] if isinstance(child, tuple)])
+
+
+def conjuncts(node):
+    """Split a parsed expression into the operands of its top level '&&'
+    chain, e.g. the individual cuts of a selection, in their written order.
+    """
+    if node[0] == 'binary' and node[1] == '&&':
+        return conjuncts(node[2]) + conjuncts(node[3])
+    return [node]
+
+
+def to_string(node, min_precedence=0):
+    """Format a parsed expression as a TTreeFormula expression, adding
+    parentheses only where the operator precedence requires them.
+    """
+    kind = node[0]
+    if kind == 'const':
+        # repr() keeps every significant digit, so the string parses back to the same value.
+        return repr(node[1])
+    if kind == 'leaf':
+        return node[1]
+    if kind == 'index':
+        return '{0}[{1}]'.format(to_string(node[1]), to_string(node[2]))
+    if kind == 'call':
+        return '{0}({1})'.format(node[1], ', '.join(to_string(argument) for argument in node[2]))
+    if kind == 'unary':
+        text = node[1] + to_string(node[2], _UNARY_PRECEDENCE)
+        precedence = _UNARY_PRECEDENCE
+    else:
+        precedence = _BINARY_PRECEDENCE[node[1]]
+        # The operators are left associative, so a right operand of equal
+        # precedence needs parentheses.
+        operator = ' {0} '.format(node[1]) if node[1] in ('&&', '||') else node[1]
+        text = '{0}{1}{2}'.format(to_string(node[2], precedence - 1), operator, to_string(node[3], precedence))
+    return '({0})'.format(text) if precedence <= min_precedence else text
+
+
+def _combine_valid(*masks):
+    """Combine validity masks, where None means every entry is valid."""
+    masks = [mask for mask in masks if mask is not None]
+    if not masks:
+        return None
+    valid = masks[0]
+    for mask in masks[1:]:
+        valid = valid & mask
+    return valid
+
+
+def _as_number(values):
+    """Promote values to double precision for arithmetic and comparisons,
+    as TTreeFormula evaluates everything in double precision.
+    """
+    return numpy.asarray(values).astype(numpy.float64, copy=False)
+
+
+def _divide(numerator, denominator):
+    """Divide elementwise, returning zero where the denominator is zero like TFormula."""
+    numerator = numpy.asarray(numerator, dtype=numpy.float64)
+    denominator = numpy.asarray(denominator, dtype=numpy.float64)
+    nonzero = denominator != 0
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(nonzero, numerator / numpy.where(nonzero, denominator, 1), 0.0)
+
+
+def _modulo(left, right):
+    """Take the integer modulo elementwise, returning zero where the divisor is zero."""
+    left = numpy.asarray(left).astype(numpy.int64)
+    right = numpy.asarray(right).astype(numpy.int64)
+    nonzero = right != 0
+    return numpy.where(nonzero, numpy.fmod(left, numpy.where(nonzero, right, 1)), 0).astype(numpy.float64)
+
+
+_BINARY_OPERATORS = {
+    '+': lambda a, b: _as_number(a) + _as_number(b),
+    '-': lambda a, b: _as_number(a) - _as_number(b),
+    '*': lambda a, b: _as_number(a) * _as_number(b),
+    '/': _divide,
+    '%': _modulo,
+    '==': lambda a, b: numpy.equal(_as_number(a), _as_number(b)),
+    '!=': lambda a, b: numpy.not_equal(_as_number(a), _as_number(b)),
+    '<': lambda a, b: numpy.less(_as_number(a), _as_number(b)),
+    '<=': lambda a, b: numpy.less_equal(_as_number(a), _as_number(b)),
+    '>': lambda a, b: numpy.greater(_as_number(a), _as_number(b)),
+    '>=': lambda a, b: numpy.greater_equal(_as_number(a), _as_number(b)),
+    '&&': lambda a, b: numpy.logical_and(a, b),
+    '||': lambda a, b: numpy.logical_or(a, b),
+}
+
+
+def _evaluate_leaf(column):
+    """Return the value of a branch used without an index, which
+    for a variable size branch is its first element.
+    """
+    if isinstance(column, JaggedColumn):
+        return column.gather(numpy.zeros(len(column), dtype=numpy.int64))
+    return column, None
+
+
+def _evaluate_node(node, columns, n_entries, evaluate_child, gather=None):
+    """Evaluate a single node given a function to evaluate its children,
+    and optionally a function gather(node, column, index) for index nodes.
+
+    Returns a tuple of the values and a mask of valid entries, or None
+    if every entry is valid. An entry is invalid if any index within the
+    expression is out of range for that entry.
+    """
+    kind = node[0]
+    if kind == 'const':
+        return numpy.full(n_entries, node[1], dtype=numpy.float64), None
+    if kind == 'leaf':
+        return _evaluate_leaf(columns[node[1]])
+    if kind == 'index':
+        column = columns[node[1][1]]
+        index, index_valid = evaluate_child(node[2])
+        if isinstance(column, JaggedColumn):
+            values, valid = gather(node, column, index) if gather else column.gather(index)
+        else:
+            # Indexing a scalar branch is only valid for the first element.
+            valid = numpy.asarray(index).astype(numpy.int64) == 0
+            values = numpy.where(valid, column, 0)
+        return values, _combine_valid(index_valid, valid)
+    if kind == 'call':
+        arguments = [evaluate_child(argument) for argument in node[2]]
+        with numpy.errstate(all='ignore'):
+            values = _FUNCTIONS[node[1]](*[_as_number(values) for values, _ in arguments])
+        return values, _combine_valid(*[valid for _, valid in arguments])
+    if kind == 'unary':
+        operand, valid = evaluate_child(node[2])
+        if node[1] == '!':
+            return numpy.logical_not(operand), valid
+        return -_as_number(operand), valid
+    if kind == 'binary':
+        left, left_valid = evaluate_child(node[2])
+        right, right_valid = evaluate_child(node[3])
+        return _BINARY_OPERATORS[node[1]](left, right), _combine_valid(left_valid, right_valid)
+    raise FormulaError('Unknown expression node {0!r}'.format(node))
+
+
+def evaluate(node, columns):
+    """Evaluate a parsed expression on a chunk of columns.
+
+    Parameters
+    ----------
+    node : tuple
+        An expression parsed by parse().
+    columns : dict
+        The referenced branches by name, as numpy arrays or JaggedColumn.
+
+    Returns
+    -------
+    values : numpy.array
+        The value of the expression for each entry.
+    valid : numpy.array of bools or None
+        Which entries had every index in range, or None if all did.
+    """
+    return EvaluationPlan([node]).evaluate(columns)[0]
+
+
+def evaluate_instance(node, columns):
+    """Evaluate a parsed expression like TTreeFormula.EvalInstance,
+    returning zero for entries where an index is out of range.
+    """
+    return EvaluationPlan([node]).evaluate_instance(columns)[0]
+
+
+def _children(node):
+    """Return the subexpressions of a node."""
+    if node[0] in ('const', 'leaf'):
+        return ()
+    if node[0] == 'call':
+        return node[2]
+    if node[0] == 'index':
+        # The indexed branch is read directly rather than evaluated.
+        return (node[2],)
+    return tuple(child for child in node[1:] if isinstance(child, tuple))
+
+
+def unindexed_leaves(node):
+    """Return the set of branch names referenced without an index by a
+    parsed expression, which TTree.Draw loops over if they are arrays.
+    """
+    if node[0] == 'leaf':
+        return {node[1]}
+    return set().union(*[unindexed_leaves(child) for child in _children(node)])
+
+
+def _instance_name(name):
+    """Return the name of the column holding the element of an array
+    branch for the current instance, which no parsed leaf can have.
+    """
+    return name + '[Iteration$]'
+
+
+def loop_instances(node, branches):
+    """Rewrite a parsed expression so that the given branches used without
+    an index refer to their element for the current instance, as held by
+    the columns returned by expand_instances().
+    """
+    kind = node[0]
+    if kind == 'leaf':
+        return ('leaf', _instance_name(node[1])) if node[1] in branches else node
+    if kind == 'index':
+        return ('index', node[1], loop_instances(node[2], branches))
+    if kind == 'call':
+        return ('call', node[1], tuple(loop_instances(argument, branches) for argument in node[2]))
+    if kind == 'unary':
+        return ('unary', node[1], loop_instances(node[2], branches))
+    if kind == 'binary':
+        return ('binary', node[1], loop_instances(node[2], branches), loop_instances(node[3], branches))
+    return node
+
+
+def expand_instances(nodes, columns):
+    """Expand a chunk of columns to one row per instance of the array
+    branches used without an index by the given expressions, like TTree.Draw
+    loops over their elements rather than taking the first one.
+
+    The number of instances of an entry is the smallest size of those
+    branches in that entry. The other columns are repeated for every
+    instance of their entry, so indexing an array branch still refers to
+    the whole array of the entry.
+
+    Parameters
+    ----------
+    nodes : list of tuples
+        The expressions parsed by parse().
+    columns : dict
+        The branches of the chunk by name, as returned by read_chunk.
+
+    Returns
+    -------
+    nodes : list of tuples
+        The expressions rewritten to be evaluated on the expanded columns.
+    columns : dict
+        The expanded columns by name.
+    entries : numpy.array of int64
+        The entry within the chunk of each instance.
+    """
+    branches = set(
+        name for name in set().union(*[unindexed_leaves(node) for node in nodes])
+        if isinstance(columns[name], JaggedColumn)
+    )
+    if not branches:
+        n_entries = len(next(iter(columns.itervalues()))) if columns else 0
+        return list(nodes), columns, numpy.arange(n_entries)
+    nodes = [loop_instances(node, branches) for node in nodes]
+    counts = numpy.minimum.reduce([columns[name].counts for name in branches])
+    entries = numpy.repeat(numpy.arange(len(counts)), counts)
+    first = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=first[1:])
+    instances = numpy.arange(len(entries)) - numpy.repeat(first[:-1], counts)
+    expanded = {}
+    for name in branches:
+        column = columns[name]
+        expanded[_instance_name(name)] = column.content[column.offsets[:-1][entries] + instances]
+    # Only the branches still referenced as a whole are repeated.
+    for name in set().union(*[leaves(node) for node in nodes]) - set(expanded):
+        column = columns[name]
+        expanded[name] = column.take_rows(entries) if isinstance(column, JaggedColumn) else column[entries]
+    return nodes, expanded, entries
+
+
+class EvaluationPlan(object):
+    """A shared evaluation plan for a set of parsed expressions.
+
+    The expressions are flattened into a single list of distinct nodes in
+    dependency order, so a subexpression common to several expressions,
+    such as 'hJCidx[0]' in 'Jet_pt[hJCidx[0]]' and 'Jet_btagCSV[hJCidx[0]]',
+    is evaluated only once per chunk. The gather positions of an index are
+    also shared between the branches whose sizes are given by the same
+    branch, e.g. all the Jet_* branches sized by nJet, so each additional
+    per-jet feature costs a single take from its content.
+
+    Parameters
+    ----------
+    nodes : list of tuples
+        The expressions parsed by parse().
+    size_branches : dict, optional
+        The name of the branch holding the size of each variable size
+        branch, as returned by size_branches(). Without it, gather
+        positions are only shared between uses of the same branch.
+    """
+    def __init__(self, nodes, size_branches=None):
+        self.outputs = list(nodes)
+        self.size_branches = size_branches or {}
+        self.steps = []
+        visited = set()
+        # Depth first traversal so that children precede their parents.
+        stack = [(node, False) for node in reversed(self.outputs)]
+        while stack:
+            node, expanded = stack.pop()
+            if node in visited:
+                continue
+            if expanded:
+                visited.add(node)
+                self.steps.append(node)
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(_children(node)) if child not in visited)
+
+    @property
+    def leaves(self):
+        """The set of branch names referenced by the expressions."""
+        return set().union(*[leaves(node) for node in self.outputs])
+
+    def evaluate(self, columns):
+        """Evaluate every expression on a chunk of columns.
+
+        Returns a list with a tuple of (values, valid) per expression,
+        as described for evaluate().
+        """
+        n_entries = len(next(iter(columns.itervalues()))) if columns else 0
+        results = {}
+        positions = {}
+
+        def gather(node, column, index):
+            # Branches sharing a size branch share the offsets, and thus the positions.
+            branch = node[1][1]
+            key = (self.size_branches.get(branch, branch), node[2])
+            if key not in positions:
+                positions[key] = column.gather_positions(index)
+            return column.take(*positions[key])
+
+        for node in self.steps:
+            results[node] = _evaluate_node(node, columns, n_entries, results.__getitem__, gather)
+        return [results[node] for node in self.outputs]
+
+    def evaluate_instance(self, columns):
+        """Evaluate every expression like TTreeFormula.EvalInstance,
+        returning zero for entries where an index is out of range.
+        """
+        return [
+            values if valid is None else numpy.where(valid, values, 0)
+            for values, valid in self.evaluate(columns)
+        ]
+
+
+def size_branches(tree, branches):
+    """Return the name of the branch holding the size of each variable
+    size branch among the given branches of a TTree.
+    """
+    sizes = {}
+    for name in branches:
+        leaf = tree.GetLeaf(name)
+        if leaf and leaf.GetLeafCount():
+            sizes[name] = leaf.GetLeafCount().GetBranch().GetName()
+    return sizes
+
+
+def filter_columns(columns, mask):
+    """Return the columns restricted to the entries selected by a boolean mask."""
+    return dict(
+        (name, column.filter(mask) if isinstance(column, JaggedColumn) else column[mask])
+        for name, column in columns.iteritems()
+    )
+
+
+def slice_columns(columns, start, stop):
+    """Return the columns restricted to the entries from start to stop."""
+    return dict(
+        (name, column.slice(start, stop) if isinstance(column, JaggedColumn) else column[start:stop])
+        for name, column in columns.iteritems()
+    )
+
+
+# The numpy types of the ROOT leaf types.
+_LEAF_DTYPES = {
+    'Bool_t': numpy.bool_,
+    'Char_t': numpy.int8,
+    'UChar_t': numpy.uint8,
+    'Short_t': numpy.int16,
+    'UShort_t': numpy.uint16,
+    'Int_t': numpy.int32,
+    'UInt_t': numpy.uint32,
+    'Long64_t': numpy.int64,
+    'ULong64_t': numpy.uint64,
+    'Float_t': numpy.float32,
+    'Double_t': numpy.float64,
+}
+
+
+def _empty_column(tree, name):
+    """Return a column of no entries with the type and layout of a branch,
+    which root_numpy can't tell without reading any entries.
+    """
+    leaf = tree.GetLeaf(name)
+    if not leaf:
+        raise FormulaError('No branch {0!r} in the tree'.format(name))
+    content = numpy.zeros(0, dtype=_LEAF_DTYPES.get(leaf.GetTypeName(), numpy.float64))
+    if leaf.GetLeafCount() or leaf.GetLenStatic() > 1:
+        return JaggedColumn(content, numpy.zeros(1, dtype=numpy.int64))
+    return content
+
+
+def read_chunk(tree, branches, start, stop):
+    """Read the given branches of a range of entries of a TTree.
+
+    Parameters
+    ----------
+    tree : ROOT.TTree
+        The tree to read.
+    branches : iterable of strings
+        The names of the branches to read. No other branch is read.
+    start, stop : int
+        The range of entries to read.
+
+    Returns
+    -------
+    columns : dict
+        The branches by name, as numpy arrays for scalar
+        branches and JaggedColumn for array branches.
+    """
+    branches = list(branches)
+    if not branches:
+        raise FormulaError('At least one branch must be read')
+    if stop <= start:
+        return dict((name, _empty_column(tree, name)) for name in branches)
+    array = root_numpy.tree2array(tree, branches=branches, start=start, stop=stop)
+    columns = {}
+    for name in branches:
+        column = array[name]
+        if column.dtype == numpy.object_ or column.ndim > 1:
+            column = JaggedColumn.from_array(column)
+        columns[name] = column
+    return columns
+
+
+class TreeReader(object):
+    """Read ranges of entries of the branches of a TTree as columns.
+
+    Parameters
+    ----------
+    path : path
+        The path or XRootD url to the ROOT file.
+    tree : string
+        The name of the tree.
+    """
+    def __init__(self, path, tree):
+        self._file = ROOT.TFile.Open(path)
+        if not self._file or self._file.IsZombie():
+            raise IOError('Cannot open {0}'.format(path))
+        self.tree = self._file.Get(tree)
+        if not self.tree:
+            raise IOError('No tree {0!r} in {1}'.format(tree, path))
+        self.n_entries = self.tree.GetEntries()
+
+    def size_branches(self, branches):
+        """Return the name of the size branch of each variable size branch."""
+        return size_branches(self.tree, branches)
+
+    def read(self, branches, start, stop):
+        """Return the branches of the entries from start to stop."""
+        return read_chunk(self.tree, branches, start, stop)
+
+    def close(self):
+        self._file.Close()
+
+
+def chunk_ranges(n_entries, chunk_size=100000, start=0, stop=None):
+    """Return the (start, stop) entry ranges splitting a tree into chunks."""
+    stop = n_entries if stop is None else min(stop, n_entries)
+    return [(chunk_start, min(chunk_start + chunk_size, stop)) for chunk_start in xrange(start, stop, chunk_size)]
+
+
+def iter_chunks(tree, branches, chunk_size=100000, start=0, stop=None):
+    """Read the given branches of a TTree in chunks of entries.
+
+    Parameters
+    ----------
+    tree : ROOT.TTree
+        The tree to read.
+    branches : iterable of strings
+        The names of the branches to read. No other branch is read.
+    chunk_size : int, optional
+        The number of entries per chunk. The default is 100000.
+    start, stop : int, optional
+        The range of entries to read. The default is the whole tree.
+
+    Yields
+    ------
+    columns : dict
+        The branches of the chunk by name, as returned by read_chunk.
+    """
+    for chunk_start, chunk_stop in chunk_ranges(tree.GetEntries(), chunk_size, start, stop):
+        yield read_chunk(tree, branches, chunk_start, chunk_stop)
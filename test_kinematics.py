@@ -0,0 +1,142 @@
+"""Check the NumPy kinematics against the TLorentzVector formulas."""
+import math
+
+import numpy
+import pytest
+
+import numpy_formula
+from kinematics import FourVectors, delta_phi, delta_r, gather, invariant_mass, to_cartesian, to_polar, wrap_phi
+
+
+def random_vectors(n, seed):
+    """Return random (pt, eta, phi, m) coordinates of jet-like particles."""
+    rng = numpy.random.RandomState(seed)
+    return rng.exponential(50, n) + 20, rng.uniform(-2.5, 2.5, n), rng.uniform(-numpy.pi, numpy.pi, n), rng.uniform(0, 20, n)
+
+
+def reference_cartesian(pt, eta, phi, mass):
+    """TLorentzVector::SetPtEtaPhiM for a single particle."""
+    pt = abs(pt)
+    px, py, pz = pt * math.cos(phi), pt * math.sin(phi), pt * math.sinh(eta)
+    p2 = px ** 2 + py ** 2 + pz ** 2
+    energy = math.sqrt(p2 + mass ** 2) if mass >= 0 else math.sqrt(max(p2 - mass ** 2, 0))
+    return px, py, pz, energy
+
+
+def reference_polar(px, py, pz, energy):
+    """TLorentzVector::Pt, Eta, Phi, and M for a single particle."""
+    p = math.sqrt(px ** 2 + py ** 2 + pz ** 2)
+    cos_theta = 1. if p == 0 else pz / p
+    if cos_theta ** 2 < 1:
+        eta = -0.5 * math.log((1. - cos_theta) / (1. + cos_theta))
+    else:
+        eta = 0. if pz == 0 else math.copysign(1e11, pz)
+    phi = 0. if px == 0 and py == 0 else math.atan2(py, px)
+    m2 = energy ** 2 - p ** 2
+    mass = -math.sqrt(-m2) if m2 < 0 else math.sqrt(m2)
+    return math.hypot(px, py), eta, phi, mass
+
+
+def reference_wrap_phi(phi):
+    """TVector2::Phi_mpi_pi for a single angle."""
+    while phi >= math.pi:
+        phi -= 2 * math.pi
+    while phi < -math.pi:
+        phi += 2 * math.pi
+    return phi
+
+
+def test_wrap_phi():
+    phis = numpy.linspace(-20, 20, 1001)
+    wrapped = wrap_phi(phis)
+    assert ((wrapped >= -numpy.pi) & (wrapped < numpy.pi)).all()
+    expected = numpy.array([reference_wrap_phi(phi) for phi in phis])
+    numpy.testing.assert_allclose(numpy.cos(wrapped - expected), 1)
+
+
+def test_delta_phi_and_delta_r():
+    eta_1, phi_1 = numpy.array([0., 1., -2.]), numpy.array([3., -3., 0.5])
+    eta_2, phi_2 = numpy.array([0., -1., -2.]), numpy.array([-3., 3., 0.5])
+    numpy.testing.assert_allclose(delta_phi(phi_1, phi_2), [6 - 2 * numpy.pi, 2 * numpy.pi - 6, 0], atol=1e-15)
+    numpy.testing.assert_allclose(delta_r(eta_1, phi_1, eta_2, phi_2), [2 * numpy.pi - 6, numpy.hypot(2, 2 * numpy.pi - 6), 0], atol=1e-15)
+
+
+def test_to_cartesian():
+    coordinates = list(random_vectors(1000, 1))
+    # Include a massless particle, a negative pt, and a negative mass.
+    coordinates[3][0] = 0
+    coordinates[0][1] *= -1
+    coordinates[3][2] = -5
+    expected = numpy.array([reference_cartesian(*x) for x in zip(*coordinates)])
+    numpy.testing.assert_allclose(numpy.column_stack(to_cartesian(*coordinates)), expected, rtol=1e-12)
+
+
+def test_to_polar():
+    components = list(to_cartesian(*random_vectors(1000, 2)))
+    # Include vectors along the beam axis, at rest, and spacelike.
+    for i, (px, py, pz, energy) in enumerate([(0, 0, 5, 6), (0, 0, -5, 6), (0, 0, 0, 1), (3, 4, 0, 1)]):
+        for component, value in zip(components, (px, py, pz, energy)):
+            component[i] = value
+    expected = numpy.array([reference_polar(*x) for x in zip(*components)])
+    numpy.testing.assert_allclose(numpy.column_stack(to_polar(*components)), expected, rtol=1e-10, atol=1e-9)
+    assert expected[0, 1] == 1e11 and expected[1, 1] == -1e11 and expected[2, 1] == 0
+    assert expected[3, 3] < 0
+
+
+def test_round_trip():
+    coordinates = random_vectors(1000, 3)
+    numpy.testing.assert_allclose(numpy.column_stack(to_polar(*to_cartesian(*coordinates))), numpy.column_stack(coordinates), rtol=1e-9)
+
+
+def test_invariant_mass():
+    jets_1, jets_2, jets_3 = [random_vectors(1000, seed) for seed in (4, 5, 6)]
+    expected = []
+    for jet_1, jet_2, jet_3 in zip(zip(*jets_1), zip(*jets_2), zip(*jets_3)):
+        total = numpy.sum([reference_cartesian(*jet) for jet in (jet_1, jet_2, jet_3)], axis=0)
+        expected.append(reference_polar(*total)[3])
+    actual = invariant_mass(*[FourVectors.from_pt_eta_phi_m(*jets) for jets in (jets_1, jets_2, jets_3)])
+    numpy.testing.assert_allclose(actual, expected, rtol=1e-9)
+
+
+def test_where():
+    v1 = FourVectors.from_pt_eta_phi_m(*random_vectors(10, 7))
+    v2 = FourVectors.from_pt_eta_phi_m(*random_vectors(10, 8))
+    condition = numpy.arange(10) % 2 == 0
+    selected = v1.where(condition, v2)
+    numpy.testing.assert_array_equal(selected.px, numpy.where(condition, v1.px, v2.px))
+    numpy.testing.assert_array_equal(selected.energy, numpy.where(condition, v1.energy, v2.energy))
+
+
+def test_gather():
+    column = numpy_formula.JaggedColumn(numpy.array([1., 2., 3., 4.]), numpy.array([0, 2, 2, 4]))
+    values, valid = gather(column, numpy.array([1, 0, 0]))
+    numpy.testing.assert_array_equal(values, [2., 0., 3.])
+    numpy.testing.assert_array_equal(valid, [True, False, True])
+    values, valid = gather(numpy.array([[1., 2.], [3., 4.]]), numpy.array([1, 2]))
+    numpy.testing.assert_array_equal(values, [2., 0.])
+    numpy.testing.assert_array_equal(valid, [True, False])
+
+
+def test_tlorentzvector_agreement():
+    ROOT = pytest.importorskip('ROOT')
+    n = 10000
+    jets_1 = random_vectors(n, 1)
+    jets_2 = random_vectors(n, 2)
+    # Include the edge case of a massless particle.
+    jets_1[3][0] = 0
+    expected = numpy.empty((n, 7))
+    for i in range(n):
+        v1 = ROOT.TLorentzVector()
+        v1.SetPtEtaPhiM(*[x[i] for x in jets_1])
+        v2 = ROOT.TLorentzVector()
+        v2.SetPtEtaPhiM(*[x[i] for x in jets_2])
+        v = v1 + v2
+        expected[i] = v.Px(), v.E(), v.Pt(), v.Eta(), v.Phi(), v.M(), v1.DeltaR(v2)
+    v1 = FourVectors.from_pt_eta_phi_m(*jets_1)
+    v2 = FourVectors.from_pt_eta_phi_m(*jets_2)
+    v = v1 + v2
+    actual = numpy.column_stack([v.px, v.energy] + list(to_polar(*v.components)) + [v1.delta_r(v2)])
+    numpy.testing.assert_allclose(actual, expected, rtol=1e-7, atol=1e-7)
+    phis = numpy.linspace(-20, 20, 1001)
+    wrapped = numpy.array([ROOT.TVector2.Phi_mpi_pi(x) for x in phis])
+    numpy.testing.assert_allclose(numpy.cos(wrap_phi(phis) - wrapped), 1)
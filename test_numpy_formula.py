@@ -0,0 +1,130 @@
+"""Check the parsing and evaluation of TTreeFormula expressions."""
+import numpy
+import pytest
+
+from numpy_formula import FormulaError, JaggedColumn, evaluate, evaluate_instance, expand_instances, parse, to_string, unindexed_leaves
+
+
+def jets():
+    """Return the columns of three events with two, zero, and three jets."""
+    return {
+        'nJet': numpy.array([2, 0, 3], dtype=numpy.int32),
+        'Jet_pt': JaggedColumn(numpy.array([50., 30., 70., 40., 20.], dtype=numpy.float32), numpy.array([0, 2, 2, 5])),
+        'met': numpy.array([10., 20., 30.]),
+    }
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('1+2*3', 7.),
+    ('(1+2)*3', 9.),
+    ('10-4-3', 3.),
+    ('24/4/2', 3.),
+    ('7%4*2', 6.),
+    ('1+2<4', 1.),
+    ('2<3==1', 1.),
+    ('1||0&&0', 1.),
+    ('(1||0)&&0', 0.),
+])
+def test_precedence(expression, expected):
+    values, valid = evaluate(parse(expression), jets())
+    numpy.testing.assert_array_equal(values, [expected] * 3)
+    assert valid is None
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('-met', [-10., -20., -30.]),
+    ('-met*2', [-20., -40., -60.]),
+    ('2--met', [12., 22., 32.]),
+    ('-(met-20)', [10., 0., -10.]),
+    ('+met', [10., 20., 30.]),
+    ('!(met>15)', [1., 0., 0.]),
+])
+def test_unary(expression, expected):
+    values, _ = evaluate(parse(expression), jets())
+    numpy.testing.assert_array_equal(values, expected)
+
+
+def test_logical_operators():
+    columns = jets()
+    values, _ = evaluate(parse('met>15 && nJet>0'), columns)
+    numpy.testing.assert_array_equal(values, [False, False, True])
+    values, _ = evaluate(parse('met>25 || nJet==2'), columns)
+    numpy.testing.assert_array_equal(values, [True, False, True])
+    values, _ = evaluate(parse('met<15 || met>25 && nJet==0'), columns)
+    numpy.testing.assert_array_equal(values, [True, False, False])
+
+
+def test_out_of_range_index():
+    columns = jets()
+    values, valid = evaluate(parse('Jet_pt[1]'), columns)
+    numpy.testing.assert_array_equal(valid, [True, False, True])
+    # Like TTreeFormula::EvalInstance, out of range entries evaluate to zero.
+    numpy.testing.assert_array_equal(evaluate_instance(parse('Jet_pt[1]'), columns), [30., 0., 40.])
+    numpy.testing.assert_array_equal(evaluate_instance(parse('Jet_pt[2]+met'), columns), [0., 0., 50.])
+    numpy.testing.assert_array_equal(evaluate_instance(parse('Jet_pt[nJet-1]'), columns), [30., 0., 20.])
+    numpy.testing.assert_array_equal(evaluate_instance(parse('Jet_pt'), columns), [50., 0., 70.])
+
+
+def test_expand_instances():
+    columns = jets()
+    columns['Jet_eta'] = JaggedColumn(numpy.array([1., 2., 3., 4.]), numpy.array([0, 1, 1, 4]))
+    node = parse('Jet_pt*(Jet_eta>1)+Jet_pt[0]/10+met')
+    assert unindexed_leaves(node) == {'Jet_pt', 'Jet_eta', 'met'}
+    (looped,), expanded, entries = expand_instances([node], columns)
+    # Like TTree.Draw, the instances of an entry are limited by its shortest array.
+    numpy.testing.assert_array_equal(entries, [0, 2, 2, 2])
+    numpy.testing.assert_array_equal(expanded['met'], [10., 30., 30., 30.])
+    values, valid = evaluate(looped, expanded)
+    numpy.testing.assert_allclose(values, [15., 107., 77., 57.])
+    assert valid.all()
+    (looped,), expanded, _ = expand_instances([parse('Jet_eta*Jet_pt[2]')], columns)
+    numpy.testing.assert_array_equal(evaluate_instance(looped, expanded), [0., 40., 60., 80.])
+
+
+def test_expand_instances_without_arrays():
+    columns = jets()
+    node = parse('Jet_pt[1]+met')
+    (looped,), expanded, entries = expand_instances([node], columns)
+    assert looped == node and expanded is columns
+    numpy.testing.assert_array_equal(entries, [0, 1, 2])
+
+
+def test_arithmetic_is_double_precision():
+    values, _ = evaluate(parse('Jet_pt[0]/3'), jets())
+    assert values.dtype == numpy.float64
+    values, _ = evaluate(parse('nJet/2'), jets())
+    numpy.testing.assert_array_equal(values, [1., 0., 1.5])
+
+
+@pytest.mark.parametrize('expression', [
+    'met^2',
+    'Sum$(Jet_pt)',
+    'met>15 ? 1 : 0',
+    'unknown(met)',
+    '(met',
+    'met met',
+])
+def test_unsupported(expression):
+    with pytest.raises(FormulaError):
+        parse(expression)
+
+
+@pytest.mark.parametrize('expression', [
+    '1+2*3',
+    '(1+2)*3',
+    'a-(b-c)',
+    '-(a+b)',
+    '!(a&&b)',
+    'a&&b || c',
+    'Jet_pt[hJCidx[0]]>30',
+    'TMath::Max(a, b)/2',
+])
+def test_to_string_round_trip(expression):
+    node = parse(expression)
+    assert parse(to_string(node)) == node
+
+
+def test_to_string_keeps_constants_exact():
+    for value in (0.1, 1. / 3, 123456789.125, 1e-300, 2.5e15):
+        node = parse(to_string(('const', value)))
+        assert node == ('const', value)
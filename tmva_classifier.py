@@ -1,18 +1,165 @@
 import uuid
 from xml.etree import ElementTree
 
-import ROOT
 import numpy
-import root_numpy.tmva
 
 
-ROOT.TMVA.Tools.Instance()
+def _import_root():
+    """Import ROOT and initialize TMVA. ROOT is only needed for training
+    and for evaluating with a TMVA.Reader, not for compiled BDTs.
+    """
+    import ROOT
+    ROOT.TMVA.Tools.Instance()
+    return ROOT
 
 
 class TMVAClassifierError(Exception):
     pass
 
 
+class BDTForest(object):
+    """A TMVA boosted decision tree forest compiled into flat NumPy node arrays.
+
+    The nodes of all trees are stored in one set of arrays. An intermediate
+    node sends an event to its right child when (x[feature] >= cut) == cut_type,
+    as in TMVA::DecisionTreeNode::GoesRight, and to its left child otherwise.
+    A leaf is its own left and right child, so every event ends up in a leaf
+    after max_depth steps, whatever the depth of the branch it follows.
+
+    Parameters
+    ----------
+    feature : numpy.array of ints
+        The index of the variable cut on by each node.
+    cut : numpy.array of float32
+        The cut value of each node. TMVA cuts on single precision values.
+    cut_type : numpy.array of bools
+        Whether the events passing the cut of each node go right.
+    left, right : numpy.array of ints
+        The index of the children of each node.
+    value : numpy.array
+        The response of each leaf: the node type (+1 or -1) or the purity
+        of AdaBoost trees, or the regression response of gradient boosted trees.
+    roots : numpy.array of ints
+        The index of the root node of each tree.
+    boost_weights : numpy.array
+        The boost weight of each tree.
+    boost_type : string
+        The TMVA BoostType, which sets how the tree responses are combined.
+    max_depth : int
+        The depth of the deepest leaf.
+    """
+    def __init__(self, feature, cut, cut_type, left, right, value, roots, boost_weights, boost_type, max_depth):
+        self.feature = feature
+        self.cut = cut
+        self.cut_type = cut_type
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.boost_weights = boost_weights
+        self.boost_type = boost_type
+        self.max_depth = max_depth
+
+    @classmethod
+    def from_xml(cls, root):
+        """Compile the forest of a parsed TMVA BDT weight file.
+
+        Raises a TMVAClassifierError for the models the Reader evaluates
+        differently, i.e. those with input variable transformations, Fisher
+        cuts, boost types other than AdaBoost, Bagging, and Grad, or
+        regression and multiclass analyses.
+        """
+        options = dict((node.attrib['name'], node.text) for node in root.findall('.//Option'))
+        boost_type = options.get('BoostType', 'AdaBoost')
+        if boost_type not in ('AdaBoost', 'Bagging', 'Grad'):
+            raise TMVAClassifierError('Cannot compile a BDT with BoostType={0}'.format(boost_type))
+        use_yes_no_leaf = options.get('UseYesNoLeaf', 'True').lower() in ('true', '1')
+        transformations = root.find('Transformations')
+        if transformations is not None and int(transformations.attrib.get('NTransformations', 0)) > 0:
+            raise TMVAClassifierError('Cannot compile a BDT with input variable transformations')
+        weights = root.find('Weights')
+        if int(weights.attrib.get('AnalysisType', 0)) != 0:
+            raise TMVAClassifierError('Cannot compile a BDT which is not a binary classifier')
+        columns = dict((name, []) for name in ('feature', 'cut', 'cut_type', 'left', 'right', 'value'))
+        roots = []
+        boost_weights = []
+        max_depth = 0
+        for tree in weights.findall('BinaryTree'):
+            regression = int(tree.attrib.get('AnalysisType', 0)) == 1
+            roots.append(len(columns['feature']))
+            boost_weights.append(float(tree.attrib['boostWeight']))
+            # Number the nodes in depth first order with an explicit stack.
+            stack = [(tree.find('Node'), None, None, 0)]
+            while stack:
+                node, parent, side, depth = stack.pop()
+                index = len(columns['feature'])
+                if parent is not None:
+                    columns[side][parent] = index
+                if int(node.attrib.get('NCoef', 0)) > 0:
+                    raise TMVAClassifierError('Cannot compile a BDT with Fisher cuts')
+                children = dict((child.attrib['pos'], child) for child in node.findall('Node'))
+                node_type = int(node.attrib['nType'])
+                if regression:
+                    value = float(node.attrib['res'])
+                elif use_yes_no_leaf:
+                    value = node_type
+                else:
+                    value = float(node.attrib['purity'])
+                leaf = node_type != 0 or not children
+                columns['feature'].append(0 if leaf else int(node.attrib['IVar']))
+                columns['cut'].append(float(node.attrib['Cut']))
+                columns['cut_type'].append(bool(int(node.attrib['cType'])))
+                columns['left'].append(index)
+                columns['right'].append(index)
+                columns['value'].append(value)
+                max_depth = max(max_depth, depth)
+                if not leaf:
+                    stack.append((children['r'], index, 'right', depth + 1))
+                    stack.append((children['l'], index, 'left', depth + 1))
+        return cls(
+            feature=numpy.array(columns['feature'], dtype=numpy.intp),
+            cut=numpy.array(columns['cut'], dtype=numpy.float32),
+            cut_type=numpy.array(columns['cut_type'], dtype=numpy.bool_),
+            left=numpy.array(columns['left'], dtype=numpy.intp),
+            right=numpy.array(columns['right'], dtype=numpy.intp),
+            value=numpy.array(columns['value'], dtype=numpy.float64),
+            roots=numpy.array(roots, dtype=numpy.intp),
+            boost_weights=numpy.array(boost_weights, dtype=numpy.float64),
+            boost_type=boost_type,
+            max_depth=max_depth,
+        )
+
+    def leaves(self, x):
+        """Return the index of the leaf reached in each tree, of shape (n_samples, n_trees)."""
+        x = numpy.asarray(x, dtype=numpy.float32)
+        rows = numpy.arange(len(x))[:, numpy.newaxis]
+        nodes = numpy.tile(self.roots, (len(x), 1))
+        for _ in xrange(self.max_depth):
+            go_right = (x[rows, self.feature[nodes]] >= self.cut[nodes]) == self.cut_type[nodes]
+            nodes = numpy.where(go_right, self.right[nodes], self.left[nodes])
+        return nodes
+
+    def evaluate(self, x, batch_size=None):
+        """Return the classifier output of each example, as the TMVA.Reader would.
+
+        The examples are traversed in batches of batch_size, which by default
+        keeps the (batch_size, n_trees) node index arrays to about a million elements.
+        """
+        x = numpy.asarray(x, dtype=numpy.float32)
+        if x.ndim != 2:
+            raise ValueError('Expected an array of shape (n_samples, n_features), found {0}'.format(x.shape))
+        batch_size = batch_size or max(1, 2 ** 20 // max(len(self.roots), 1))
+        output = numpy.empty(len(x), dtype=numpy.float64)
+        for start in xrange(0, len(x), batch_size):
+            responses = self.value[self.leaves(x[start:start + batch_size])]
+            if self.boost_type == 'Grad':
+                output[start:start + batch_size] = 2. / (1. + numpy.exp(-2. * responses.sum(axis=1))) - 1.
+            else:
+                norm = self.boost_weights.sum()
+                output[start:start + batch_size] = responses.dot(self.boost_weights) / norm if norm > numpy.finfo(float).eps else 0.
+        return output
+
+
 class TMVAClassifier(object):
     """A TMVA classifier wrapper.
 
@@ -43,6 +190,8 @@ class TMVAClassifier(object):
             self.name = name or uuid.uuid4().hex
             self.params = params
             self._reader = None
+            self._forest = None
+            self._weights = None
 
     def __repr__(self):
         return "{0}(method='{1}', {2})".format(
@@ -52,8 +201,14 @@ class TMVAClassifier(object):
         )
 
     def _load_from_weights(self, path):
-        """Load a TMVA model from its XML weight file."""
+        """Load a TMVA model from its XML weight file.
+
+        BDTs are compiled into a BDTForest, so they can be evaluated without
+        ROOT. Other methods, and BDTs which can't be compiled, are loaded into
+        a TMVA.Reader.
+        """
         root = ElementTree.parse(path).getroot()
+        self._weights = path
         self.name = root.attrib['Method']
         self.method = self.name.split('::')[0]
         # Only keep modified options.
@@ -61,18 +216,36 @@ class TMVAClassifier(object):
         for node in root.findall('.//Option'):
             if node.attrib['modified'] == 'Yes':
                 self.params[node.attrib['name']] = node.text
-        # Setup the Reader to immediately enable inference.
-        self._reader = ROOT.TMVA.Reader('Silent')
+        self._forest = self._compile(root)
+        self._reader = None
+        if self._forest is None:
+            self._reader = self._book_reader(root, path)
+
+    def _compile(self, root):
+        """Return the BDTForest of a parsed weight file, or None if it can't be compiled."""
+        if self.method != 'BDT':
+            return None
+        try:
+            return BDTForest.from_xml(root)
+        except TMVAClassifierError:
+            return None
+
+    @staticmethod
+    def _book_reader(root, path):
+        """Return a TMVA.Reader booked with the method of a parsed weight file."""
+        ROOT = _import_root()
+        reader = ROOT.TMVA.Reader('Silent')
         for node in root.findall('.//Variable'):
             if node.attrib['Type'] == 'F':
-                self._reader.AddVariable(node.attrib['Internal'], numpy.array([0], dtype=numpy.float32))
+                reader.AddVariable(node.attrib['Internal'], numpy.array([0], dtype=numpy.float32))
             elif node.attrib['Type'] == 'I':
-                self._reader.AddVariable(node.attrib['Internal'], numpy.array([0], dtype=numpy.int32))
+                reader.AddVariable(node.attrib['Internal'], numpy.array([0], dtype=numpy.int32))
             else:
                 raise TMVAClassifierError(
                     'Encountered unexpected variable type while loading weights from {0}: {1!r}'.format(path, node.attrib)
                 )
-        self._reader.BookMVA(self.name, path)
+        reader.BookMVA(root.attrib['Method'], path)
+        return reader
 
     @staticmethod
     def load_train_val_data(x, y, weights=None, validation_data=None):
@@ -99,6 +272,8 @@ class TMVAClassifier(object):
         data_loader : ROOT.TMVA.DataLoader
             A DataLoader instance prepared with training and validation data.
         """
+        ROOT = _import_root()
+        import root_numpy.tmva
         data_loader = ROOT.TMVA.DataLoader()
         try:
             # Training data is DataFrame-like.
@@ -126,7 +301,7 @@ class TMVAClassifier(object):
         if validation_data:
             if len(validation_data) == 2:
                 x_val, y_val = validation_data
-                add_classification_events(data_loader, x_val, y_val, test=True)
+                root_numpy.tmva.add_classification_events(data_loader, x_val, y_val, test=True)
             elif len(validation_data) == 3:
                 x_val, y_val, weights_val = validation_data
                 root_numpy.tmva.add_classification_events(data_loader, x_val, y_val, weights=weights_val, test=True)
@@ -159,6 +334,7 @@ class TMVAClassifier(object):
         weights : numpy array-like, optional
             The event weights for the training data as an array of shape (n_samples, 1).
         """
+        ROOT = _import_root()
         outfile = ROOT.TFile.Open('TMVAClassifier_{0}.root'.format(self.name), 'recreate')
         tmva_options = 'AnalysisType=Classification:!DrawProgressBar'
         if not verbose:
@@ -183,24 +359,37 @@ class TMVAClassifier(object):
                 self._reader.AddVariable(feature.GetInternalName(), numpy.array([0], dtype=numpy.int32))
             else:
                 raise TMVAClassifierError('Classification features must be a subtype of integer or float')
-        self._reader.BookMVA(self.name, 'default/weights/TMVAClassifier_{0}.weights.xml'.format(self.name))
+        self._weights = 'default/weights/TMVAClassifier_{0}.weights.xml'.format(self.name)
+        self._reader.BookMVA(self.name, self._weights)
+        self._forest = self._compile(ElementTree.parse(self._weights).getroot())
         return self
 
-    def evaluate(self, x):
+    def evaluate(self, x, use_reader=False):
         """Evaluate the classifier on a set of examples.
 
+        Compiled BDTs are evaluated with NumPy, all examples at once, and
+        agree with the TMVA.Reader to floating point precision.
+
         Parameters
         ----------
         x : numpy array-like
             An array of shape (n_samples, n_features). The features must be
             provided in the same order presented during training.
+        use_reader : bool, optional
+            Whether to evaluate a compiled BDT with the TMVA.Reader instead,
+            e.g. to cross-check the two. The default is False.
 
         Returns
         -------
         numpy array
             The classifier output values as a numpy array of shape (n_samples, 1).
         """
+        if self._forest is not None and not use_reader:
+            return self._forest.evaluate(x)
+        if self._reader is None and self._forest is not None:
+            self._reader = self._book_reader(ElementTree.parse(self._weights).getroot(), self._weights)
         if self._reader:
+            import root_numpy.tmva
             return root_numpy.tmva.evaluate_reader(self._reader, self.name, x)
         else:
             raise TMVAClassifierError('The classifier must be fit before predictions can be made')
@@ -241,6 +430,7 @@ class TMVAClassifier(object):
             For more information about these metrics, please see the TMVA User's
             Guide section on classification performance evaluation (3.1.10).
         """
+        ROOT = _import_root()
         data_loader = self.load_train_val_data(x, y, weights, validation_data)
         cv = ROOT.TMVA.CrossValidation(data_loader)
         cv.SetNumFolds(n_folds or 5)